@@ -3,65 +3,115 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 from datetime import datetime
-from meteostat import Point, Hourly
 import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from meteo import cargar_horario
+from lectura_datos import leer_accidentalidad, memoria_mb
 
-# Ruta de los archivos originales
-ruta_csv = r'C:\Users\Juan Mendoza\Juan\Kschool\Clases\TFM\Notebooks\Dataset originales'
-
-# Función para clasificar la lluvia según mm/hora
-def clasificar_lluvia(mm_por_hora):
-    if pd.isna(mm_por_hora) or mm_por_hora == 0:
-        return "Despejado"
-    elif 0.1 <= mm_por_hora < 2:
-        return "Lluvia débil"
-    elif 2 <= mm_por_hora < 10:
-        return "Lluvia moderada"
-    elif 10 <= mm_por_hora < 50:
-        return "Lluvia fuerte"
-    else:
-        return "Lluvia torrencial"
+# Ruta de los archivos originales (pipeline.py la pasa en TFM_RUTA_ORIGINALES)
+ruta_csv = os.environ.get('TFM_RUTA_ORIGINALES', r'C:\Users\Juan Mendoza\Juan\Kschool\Clases\TFM\Notebooks\Dataset originales')
+
+# Función para imputar el estado meteorológico de todo el año de una sola vez.
+# Cruzamos la columna 'dia_hora' (ya redondeada a la hora) con la serie horaria
+# clasificada de meteostat, y lo que siga vacío se rellena con la moda.
+def imputar_estado_meteorologico(new_df, clasificacion):
+    inicio = time.perf_counter()
+    faltantes = new_df['estado_meteorológico'].isna()
+    n_faltantes = int(faltantes.sum())
+
+    # Unión por columnas: buscamos cada hora en el índice de la serie de meteostat
+    clasificacion = clasificacion[~clasificacion.index.duplicated(keep='first')]
+    imputados = clasificacion.reindex(new_df.loc[faltantes, 'dia_hora']).to_numpy()
+    new_df.loc[faltantes, 'estado_meteorológico'] = imputados
+    n_meteostat = int(pd.notna(imputados).sum())
+
+    # Imputar la moda si queda algún NaN
+    restantes = new_df['estado_meteorológico'].isna()
+    n_moda = int(restantes.sum())
+    if n_moda:
+        new_df.loc[restantes, 'estado_meteorológico'] = new_df['estado_meteorológico'].mode()[0]
 
-# Cargar datos meteorológicos clasificados (de meteostat)
-madrid = Point(40.4168, -3.7038)
-start = datetime(2021, 1, 1)
-end = datetime(2024, 12, 31)
-data = Hourly(madrid, start, end).fetch()
-data['estado_meteorologico_clasificado'] = data['prcp'].apply(clasificar_lluvia)
+    print(f"  Filas: {len(new_df)} | sin estado meteorológico: {n_faltantes} | "
+          f"imputadas con meteostat: {n_meteostat} | imputadas con la moda: {n_moda} | "
+          f"tiempo: {time.perf_counter() - inicio:.3f} s")
+    return new_df
 
 # --- PROCESAMIENTO PARA CADA AÑO ---
 
-columns_to_drop = [
-    'numero', 'rango_edad', 'sexo',
-    'cod_lesividad', 'lesividad',
-    'positiva_alcohol', 'positiva_droga'
-]
 columnas = [
     'num_expediente', 'dia_hora', 'cod_distrito', 'distrito',
     'tipo_accidente', 'estado_meteorológico', 'tipo_vehiculo', 'tipo_persona'
 ]
 
-for year in range(2021, 2025):
+# Función que procesa un año completo: lectura, limpieza, imputación y exportación.
+# Los años son independientes entre sí, así que se puede ejecutar en paralelo.
+def procesar_anio(year, clasificacion):
     print(f"\nProcesando año {year}...")
     file_path = os.path.join(ruta_csv, f'{year}_Accidentalidad.csv')
-    df = pd.read_csv(file_path, delimiter=';')
-    df = df.drop(columns=columns_to_drop)
-    # Crear columna 'dia_hora'
-    df['dia_hora'] = df['fecha'] + ' ' + df['hora']
-    df['dia_hora'] = pd.to_datetime(df['dia_hora'], format='%d/%m/%Y %H:%M:%S').dt.floor('h')
+    # Lectura por bloques con esquema de tipos (solo las columnas que usamos)
+    df = leer_accidentalidad(file_path, original=True)
+    print(f"Memoria [01 carga {year}]: {memoria_mb(df):.1f} MB ({len(df)} filas)")
+    # Redondear 'dia_hora' a la hora para cruzarla con meteostat
+    df['dia_hora'] = df['dia_hora'].dt.floor('h')
     # Seleccionar columnas relevantes
-    new_df = df[columnas]
-    # Imputar estado meteorológico usando meteostat
-    for index, row in new_df.iterrows():
-        if pd.isna(row['estado_meteorológico']):
-            fecha_hora_accidente = row['dia_hora']
-            precipitacion = data['estado_meteorologico_clasificado'].get(fecha_hora_accidente, None)
-            if precipitacion is not None:
-                new_df.loc[index, 'estado_meteorológico'] = precipitacion
-    # Imputar la moda si queda algún NaN
-    new_df['estado_meteorológico'].fillna(new_df['estado_meteorológico'].mode()[0], inplace=True)
+    new_df = df[columnas].copy()
+    # Imputar estado meteorológico usando meteostat (y la moda para lo que quede)
+    new_df = imputar_estado_meteorologico(new_df, clasificacion)
     # Exportar a CSV
     new_df.to_csv(f'{year}_Accidentalidad_COMPLETO.csv', index=False)
     print(f"Archivo {year}_Accidentalidad_COMPLETO.csv exportado correctamente.")
+    return year
+
+# --- MODO PARALELO ---
+# La serie meteorológica se guarda una vez en ficheros .npy (horas y códigos de
+# categoría) y cada proceso los abre en modo memoria compartida (mmap) al arrancar,
+# en lugar de enviar la tabla serializada con cada tarea.
+
+clasificacion_compartida = None
+
+def guardar_clasificacion_compartida(clasificacion, carpeta):
+    clasificacion = clasificacion.astype('category')
+    ruta_horas = os.path.join(carpeta, 'horas.npy')
+    ruta_codigos = os.path.join(carpeta, 'codigos.npy')
+    np.save(ruta_horas, clasificacion.index.to_numpy(dtype='datetime64[ns]'))
+    np.save(ruta_codigos, clasificacion.cat.codes.to_numpy())
+    return ruta_horas, ruta_codigos, list(clasificacion.cat.categories)
+
+def iniciar_trabajador(ruta_horas, ruta_codigos, categorias):
+    global clasificacion_compartida
+    horas = np.load(ruta_horas, mmap_mode='r')
+    codigos = np.load(ruta_codigos, mmap_mode='r')
+    clasificacion_compartida = pd.Series(pd.Categorical.from_codes(codigos, categorias),
+                                         index=pd.DatetimeIndex(horas))
+
+def procesar_anio_compartido(year):
+    return procesar_anio(year, clasificacion_compartida)
+
+# Ejecutar como script (python "01. Preparación Datasets.py") para que los procesos
+# hijos puedan importar las funciones anteriores sin repetir la carga meteorológica.
+if __name__ == '__main__':
+    # Modo offline: solo se leen los datos meteorológicos de la caché local (sin red)
+    modo_offline = os.environ.get('METEO_OFFLINE', '0') == '1'
+    # Número de procesos: 1 = modo secuencial (por defecto)
+    n_procesos = int(os.environ.get('TFM_PROCESOS', '1'))
+
+    # Cargar datos meteorológicos clasificados (de meteostat, a través de la caché local)
+    madrid = (40.4168, -3.7038)
+    start = datetime(2021, 1, 1)
+    end = datetime(2024, 12, 31)
+    data = cargar_horario(*madrid, start, end, offline=modo_offline)
+
+    years = range(2021, 2025)
+    if n_procesos <= 1:
+        for year in years:
+            procesar_anio(year, data['estado_meteorologico_clasificado'])
+    else:
+        with tempfile.TemporaryDirectory() as carpeta:
+            compartida = guardar_clasificacion_compartida(data['estado_meteorologico_clasificado'], carpeta)
+            with ProcessPoolExecutor(max_workers=min(n_procesos, len(years)),
+                                     initializer=iniciar_trabajador, initargs=compartida) as pool:
+                list(pool.map(procesar_anio_compartido, years))
 
-print("\nProcesamiento de años 2021-2024 completado.")
\ No newline at end of file
+    print("\nProcesamiento de años 2021-2024 completado.")
\ No newline at end of file
@@ -1,20 +1,39 @@
-import pandas as pd
+from lectura_datos import (iterar_accidentalidad, escribir_particion, particion_actualizada, arrow_actualizado,
+                           exportar_arrow, memoria_mb)
 
-# Unir los 4 datasets en un solo DataFrame sin pérdida de datos
-archivos = [
-    '2021_Accidentalidad_COMPLETO.csv',
-    '2022_Accidentalidad_COMPLETO.csv',
-    '2023_Accidentalidad_COMPLETO.csv',
-    '2024_Accidentalidad_COMPLETO.csv'
-]
+# Unir los datasets anuales en un dataset Parquet particionado por año.
+# Cada año es una partición (Accidentalidad_unido/anio=AAAA), así que añadir un año
+# nuevo solo escribe su partición y los años ya procesados no se vuelven a leer.
+ruta_dataset = 'Accidentalidad_unido'
+# Copia en Arrow IPC (un fichero por año) para abrirla con memory map en la etapa 03
+ruta_arrow = 'Accidentalidad_unido.arrow'
+archivos = {
+    2021: '2021_Accidentalidad_COMPLETO.csv',
+    2022: '2022_Accidentalidad_COMPLETO.csv',
+    2023: '2023_Accidentalidad_COMPLETO.csv',
+    2024: '2024_Accidentalidad_COMPLETO.csv'
+}
 
-dfs = [pd.read_csv(archivo, delimiter=',') for archivo in archivos]
-df_unido = pd.concat(dfs, ignore_index=True)
-
-# Comprobar el resultado
-df_unido.info()
-df_unido.head()
+# Función para anotar la memoria de cada bloque mientras se escribe la partición
+def medir_bloques(bloques, memoria):
+    for bloque in bloques:
+        memoria.append(memoria_mb(bloque))
+        yield bloque
 
+for anio, archivo in archivos.items():
+    if particion_actualizada(ruta_dataset, anio, archivo):
+        print(f"Partición {anio} al día, no se vuelve a escribir.")
+    else:
+        # Leemos el archivo por bloques tipados y los escribimos directamente en su partición
+        memoria = []
+        filas = escribir_particion(medir_bloques(iterar_accidentalidad(archivo), memoria), ruta_dataset, anio)
+        print(f"Partición {anio} guardada con {filas} filas ({archivo}).")
+        print(f"Memoria [02 partición {anio}]: {sum(memoria):.1f} MB en {len(memoria)} bloques "
+              f"(máximo {max(memoria, default=0):.1f} MB por bloque)")
+    # Solo se vuelca a Arrow el año cuya partición ha cambiado
+    if not arrow_actualizado(ruta_dataset, anio, ruta_arrow):
+        filas = exportar_arrow(ruta_dataset, anio, ruta_arrow)
+        print(f"Archivo {ruta_arrow}/anio={anio}.arrow guardado con {filas} filas.")
 
-# Guardar el DataFrame unido en un archivo CSV
-df_unido.to_csv('Accidentalidad_2021_2024_unido.csv', index=False)
\ No newline at end of file
+# Comprobar el resultado
+print(f"Dataset {ruta_dataset} actualizado con los años {list(archivos)}.")
\ No newline at end of file
@@ -6,6 +6,11 @@ from datetime import datetime, timedelta
 import itertools
 import warnings
 import re
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lectura_datos import abrir_arrow, aplicar_tipos
+from calendario import FRANJAS, HORAS_POR_FRANJA, franja_de_hora, tabla_calendario, unir_calendario
+from agregados import abrir_agregados, vaciar_agregados, actualizar_agregados, tablas_agregadas
 warnings.filterwarnings('ignore')
 
 # Función para corregir caracteres mal codificados
@@ -29,51 +34,97 @@ def corregir_encoding(texto):
     
     return texto
 
+# Función para aplicar una corrección de texto una sola vez por valor distinto.
+# En las categóricas se corrigen sus categorías y en el resto se usa un mapa de
+# valores únicos, así el coste no depende del número de filas.
+def corregir_por_valor(serie, funcion):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        categorias = serie.cat.categories
+        corregidas = pd.Index([funcion(c) for c in categorias])
+        if corregidas.equals(categorias):
+            return serie
+        if corregidas.is_unique:
+            return serie.cat.rename_categories(corregidas)
+        # Dos categorías mal codificadas pueden corresponder al mismo valor corregido
+        return serie.map(dict(zip(categorias, corregidas))).astype('category')
+
+    codigos, unicos = pd.factorize(serie)
+    corregidos = [funcion(valor) for valor in unicos]
+    if corregidos == list(unicos):
+        return serie
+    valores = np.array(corregidos, dtype=object).take(codigos)
+    valores[codigos == -1] = None
+    return pd.Series(valores, index=serie.index, name=serie.name)
+
 # Función para corregir todas las columnas de texto en el DataFrame
 def corregir_df(df):
-    # Hacemos una copia para evitar problemas de modificación durante la iteración
-    df_corregido = df.copy()
-    
-    # Aplicamos la corrección a todas las columnas de texto
-    for columna in df_corregido.select_dtypes(include=['object']).columns:
+    # Sin copiar el DataFrame: solo se sustituyen las columnas de texto corregidas,
+    # el resto siguen apuntando a los datos cargados
+    for columna in df.select_dtypes(include=['object', 'string', 'category']).columns:
+        # El número de expediente es un identificador sin tildes
+        if columna == 'num_expediente':
+            continue
         print(f"Corrigiendo columna: {columna}")
-        df_corregido[columna] = df_corregido[columna].apply(corregir_encoding)
+        df[columna] = corregir_por_valor(df[columna], corregir_encoding)
         
-    return df_corregido
+    return df
 
 # 1. CARGA DE DATOS
 # Cargamos el dataset procesado de accidentes de 2020 con la ruta completa
 
-ruta_archivo = r'C:\Users\afono\Desktop\TFM - ALBERT FONOLLET TORRUBIANO\TFM_Kschool\Dataset utilizado por TFM_agregados_final (tras pipeline n2)\Accidentalidad_2021_2024_unido.csv'
+# En modo incremental (TFM_INCREMENTAL=1) se carga solo el lote nuevo de TFM_RUTA_LOTE
+# (un fichero Arrow con las mismas columnas, o una carpeta de ficheros)
+modo_incremental = os.environ.get('TFM_INCREMENTAL', '0') == '1'
+if modo_incremental:
+    ruta_archivo = os.environ.get('TFM_RUTA_LOTE')
+    if not ruta_archivo:
+        raise ValueError("El modo incremental necesita la ruta del lote en TFM_RUTA_LOTE")
+else:
+    ruta_archivo = os.environ.get('TFM_RUTA_UNIDO', r'C:\Users\afono\Desktop\TFM - ALBERT FONOLLET TORRUBIANO\TFM_Kschool\Dataset utilizado por TFM_agregados_final (tras pipeline n2)\Accidentalidad_unido.arrow')
 print(f"Cargando archivo: {ruta_archivo}")
 
-# Codificamos con latin-1
-df_2020 = pd.read_csv(ruta_archivo, encoding='latin-1')
+# Abrimos la copia Arrow del dataset unido con memory map (sin volver a parsear ni copiar)
+df_2020 = abrir_arrow(ruta_archivo)
 
-# Aplicamos la corrección de caracteres mal codificados
+# Aplicamos la corrección de caracteres mal codificados (sobre las categorías)
 print("Corrigiendo caracteres mal codificados en el dataset inicial...")
 df_2020 = corregir_df(df_2020)
 
+# Política de tipos común: texto repetido como categórico y conteos como enteros pequeños
+df_2020 = aplicar_tipos(df_2020, etapa='03 carga')
+
 # Corregimos también los nombres de las columnas
 columnas_originales = df_2020.columns.tolist()
 columnas_corregidas = [corregir_encoding(col) for col in columnas_originales]
 df_2020.columns = columnas_corregidas
 
+# Función para sustituir los valores marcados por uno nuevo. En las columnas
+# categóricas se añade la categoría nueva y se quitan las que quedan sin uso.
+def sustituir_valores(serie, mascara, nuevo):
+    serie = serie.copy()
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        if nuevo not in serie.cat.categories:
+            serie = serie.cat.add_categories([nuevo])
+        serie[mascara] = nuevo
+        return serie.cat.remove_unused_categories()
+    serie[mascara] = nuevo
+    return serie
+
 # Reemplazamos "Se desconoce" en estado_meteorológico por "Despejado"
 if 'estado_meteorológico' in df_2020.columns:
     desconocidos = df_2020['estado_meteorológico'].isin(['Se desconoce', 'se desconoce', ''])
-    df_2020.loc[desconocidos, 'estado_meteorológico'] = 'Despejado'
+    df_2020['estado_meteorológico'] = sustituir_valores(df_2020['estado_meteorológico'], desconocidos, 'Despejado')
 
 # Reemplazamos valores vacíos o 0 en tipo_vehiculo por "Turismo"
 if 'tipo_vehiculo' in df_2020.columns:
     vacios = df_2020['tipo_vehiculo'].isin(['', '0', 0, 'Sin especificar', 'sin especificar']) | df_2020['tipo_vehiculo'].isna()
-    df_2020.loc[vacios, 'tipo_vehiculo'] = 'Turismo'
+    df_2020['tipo_vehiculo'] = sustituir_valores(df_2020['tipo_vehiculo'], vacios, 'Turismo')
 
 
 # 2. AGREGACIÓN POR DISTRITO
 
 # Contamos los accidentes por distrito
-accidentes_por_distrito = df_2020.groupby('distrito')['num_expediente'].nunique().reset_index()
+accidentes_por_distrito = df_2020.groupby('distrito', observed=True)['num_expediente'].nunique().reset_index()
 accidentes_por_distrito.columns = ['distrito', 'num_accidentes']
 
 # Ordenamos por número de accidentes (descendente)
@@ -82,7 +133,11 @@ accidentes_por_distrito = accidentes_por_distrito.sort_values('num_accidentes',
 # 3. CLASIFICACIÓN DE DISTRITOS POR NIVEL DE ACCIDENTALIDAD
 
 # Dividimos en 4 grupos 
-accidentes_por_distrito['grupo_distrito'] = pd.qcut(accidentes_por_distrito.index, 4, labels=['Alto', 'Medio-Alto', 'Medio-Bajo', 'Bajo'])
+def agrupar_distritos(accidentes_por_distrito):
+    accidentes_por_distrito['grupo_distrito'] = pd.qcut(accidentes_por_distrito.index, 4, labels=['Alto', 'Medio-Alto', 'Medio-Bajo', 'Bajo'])
+    return accidentes_por_distrito
+
+accidentes_por_distrito = agrupar_distritos(accidentes_por_distrito)
 
 # Creamos un mapeo de distrito a grupo para aplicarlo al dataset original
 mapeo_distritos = dict(zip(accidentes_por_distrito['distrito'], accidentes_por_distrito['grupo_distrito']))
@@ -90,38 +145,27 @@ df_2020['grupo_distrito'] = df_2020['distrito'].map(mapeo_distritos)
 
 # 4. AGREGACIÓN TEMPORAL
 
-# Extraemos el día de la semana de la columna de fecha. 
+# Día de la semana (en español), hora y franja horaria salen de la tabla calendario,
+# que se calcula una vez para todo el rango de fechas y se une por una clave entera
+# (dia_hora ya viene como fecha desde el fichero Arrow, no hace falta convertirla)
 if 'dia_hora' in df_2020.columns:
-    fecha_col = 'dia_hora'
-    df_2020['dia_semana'] = pd.to_datetime(df_2020[fecha_col]).dt.day_name()
-    
-    # Traducir los nombres de los días al español
-    traduccion = {
-        'Monday': 'Lunes', 'Tuesday': 'Martes', 'Wednesday': 'Miércoles',
-        'Thursday': 'Jueves', 'Friday': 'Viernes', 'Saturday': 'Sábado', 'Sunday': 'Domingo'
-    }
-    df_2020['dia_semana'] = df_2020['dia_semana'].map(lambda x: traduccion.get(x, x))
-    
-    # Extraer la hora y crear la franja horaria
-    df_2020['hora'] = pd.to_datetime(df_2020['dia_hora']).dt.hour
-    df_2020['franja_horaria'] = df_2020['hora'].apply(lambda h: 
-        'Mañana' if 6 <= h < 12 else
-        'Tarde' if 12 <= h < 18 else
-        'Noche' if 18 <= h < 22 else
-        'Madrugada'
-    )
+    calendario = tabla_calendario(df_2020['dia_hora'].min(), df_2020['dia_hora'].max(), festivos=False)
+    df_2020 = unir_calendario(df_2020, calendario, ['dia_semana', 'hora', 'franja_horaria'])
     
     # Ahora podemos agrupar por día de la semana
-    accidentes_por_dia = df_2020.groupby('dia_semana')['num_expediente'].nunique()
+    accidentes_por_dia = df_2020.groupby('dia_semana', observed=True)['num_expediente'].nunique()
     # Reordenamos los días
     orden_dias = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
     accidentes_por_dia = accidentes_por_dia.reindex(orden_dias)
 
+# Las columnas nuevas (día de la semana, franja horaria, grupo de distrito) también como categóricas
+df_2020 = aplicar_tipos(df_2020, etapa='03 variables temporales')
+
     
 
 # MOmento del día
 if 'momento_dia' in df_2020.columns:
-    accidentes_por_momento = df_2020.groupby('momento_dia')['num_expediente'].nunique()
+    accidentes_por_momento = df_2020.groupby('momento_dia', observed=True)['num_expediente'].nunique()
     # Reordenamos si existen todas las categorías
     try:
         accidentes_por_momento = accidentes_por_momento.reindex(['Mañana', 'Tarde', 'Noche', 'Madrugada'])
@@ -132,7 +176,7 @@ else:
 
 # 6. AGREGACIÓN POR TIPO DE ACCIDENTE
 
-accidentes_por_tipo = df_2020.groupby('tipo_accidente')['num_expediente'].nunique().sort_values(ascending=False)
+accidentes_por_tipo = df_2020.groupby('tipo_accidente', observed=True)['num_expediente'].nunique().sort_values(ascending=False)
 
 # 7. AGREGACIÓN POR CONDICIONES METEOROLÓGICAS
 
@@ -141,192 +185,180 @@ columnas_meteo = [col for col in df_2020.columns if 'meteoro' in col.lower()]
 if columnas_meteo:
     columna_meteo = columnas_meteo[0]
     print(f"Usando columna meteorológica: {columna_meteo}")
-    accidentes_por_meteo = df_2020.groupby(columna_meteo)['num_expediente'].nunique().sort_values(ascending=False)
+    accidentes_por_meteo = df_2020.groupby(columna_meteo, observed=True)['num_expediente'].nunique().sort_values(ascending=False)
 else:
     print("No se encontró columna meteorológica")
     accidentes_por_meteo = pd.Series(df_2020['num_expediente'].nunique(), index=['Total'])
 
 # 8. FUNCIÓN PARA CALCULAR ÍNDICE DE GRAVEDAD
 
-def calcular_indice_gravedad(row):
-    
+# Tabla de pesos del índice de gravedad. Para ajustar el índice basta con cambiar
+# estos valores, sin tocar la función de cálculo.
+# En las reglas de texto se aplica la primera regla que se cumpla: cada regla es
+# una lista de alternativas y cada alternativa una tupla de palabras que tienen que
+# aparecer todas en el texto (en minúsculas).
+pesos_gravedad = {
     # Base: todos los accidentes empiezan con un valor base establecido a 1
-    gravedad = 1.0
-    
+    'base': 1.0,
     # Factor por tipo de personas involucradas
-    if 'Peatones' in row and row['Peatones'] > 0:
-        gravedad += 3.0  # Los accidentes con peatones son potencialmente más graves
-    
+    'peatones': 3.0,  # Los accidentes con peatones son potencialmente más graves
     # Factor por tipo de vehículos
-    if 'Vehículo de dos ruedas' in row and row['Vehículo de dos ruedas'] > 0:
-        gravedad += 1.8  # Vehículos de dos ruedas aumentan la gravedad potencial
-    if 'Vehículo pesado' in row and row['Vehículo pesado'] > 0:
-        gravedad += 1.5  # Vehículos pesados aumentan la gravedad
-        
-    # Factor por número de implicados
-    if 'total_implicados' in row:
-        gravedad += (row['total_implicados'] - 1) * 0.1
+    'dos_ruedas': 1.8,  # Vehículos de dos ruedas aumentan la gravedad potencial
+    'pesado': 1.5,  # Vehículos pesados aumentan la gravedad
+    # Factor por número de implicados y por diversidad de vehículos (a partir del primero)
+    'por_implicado': 0.1,
+    'por_tipo_vehiculo': 0.15,
+    # Factor por tipo de accidente
+    'tipo_accidente': [
+        ([('atropello', 'animal')], 1.0),  # Atropello a animal es menos grave que a persona
+        ([('atropello',)], 2.0),  # Atropello a persona es muy grave
+        ([('colisión frontal',)], 1.8),  # Colisión frontal es muy grave
+        ([('colisión fronto-lateral',), ('fronto',)], 1.5),  # Colisión fronto-lateral es grave
+        ([('colisión lateral',)], 1.2),  # Colisión lateral es moderadamente grave
+        ([('colisión múltiple',), ('multiple',)], 1.7),  # Colisión múltiple suele ser grave
+        ([('alcance',)], 1.0),  # Alcance es menos grave que otras colisiones
+        ([('choque', 'obstáculo')], 1.3),  # Choque contra obstáculo fijo
+        ([('vuelco',)], 1.7),  # Vuelco es bastante grave
+        ([('caída',), ('caida',)], 1.6),  # Caída (especialmente para vehículos de dos ruedas)
+        ([('salida', 'vía'), ('solo salida',)], 1.4),  # Salida de vía
+        ([('despeñamiento',), ('despen',)], 1.9),  # Despeñamiento es muy grave
+    ],
+    # Factor por hora del día: (desde, hasta, peso)
+    'hora': [
+        (0, 6, 0.6),  # Madrugada (mayor riesgo por fatiga y visibilidad)
+        (6, 9, 0.4),  # Hora punta mañana
+        (9, 17, 0.1),  # Horario laboral (menor riesgo)
+        (17, 20, 0.4),  # Hora punta tarde
+        (20, 23, 0.5),  # Noche
+    ],
+    # Factor por día de la semana
+    'dia_semana': [
+        ([('viernes',)], 0.2),  # Viernes tarde/noche suele tener accidentes más graves
+        ([('sábado',), ('sabado',)], 0.3),  # Fin de semana
+        ([('domingo',)], 0.3),  # Fin de semana
+        ([('lunes',), ('lun',)], 0.1),  # Lunes tiene ligeramente más accidentes por fatiga post-fin de semana
+    ],
+    # Factor por estado meteorológico ('despejado' tiene que coincidir exactamente)
+    'meteo_exacto': {
+        'despejado': 0.0,  # Condiciones óptimas, no aumenta el riesgo
+    },
+    'meteo': [
+        ([('lluvia débil',), ('lluvia debil',)], 0.8),  # Lluvia débil aumenta moderadamente el riesgo
+        ([('lluvia intensa',), ('llubia intensa',)], 1.5),  # Lluvia intensa aumenta significativamente el riesgo
+        ([('granizando',), ('granizo',)], 1.8),  # Granizo es muy peligroso para la conducción
+        ([('nevando',), ('nieve',)], 2.0),  # Nieve es extremadamente peligrosa
+        ([('nublado',)], 0.3),  # Nublado reduce ligeramente la visibilidad
+    ],
+}
+
+# Peso de un texto según la primera regla que cumpla
+def peso_por_reglas(texto, reglas, exactas=None):
+    if exactas and texto in exactas:
+        return exactas[texto]
+    for alternativas, peso in reglas:
+        if any(all(palabra in texto for palabra in alternativa) for alternativa in alternativas):
+            return peso
+    return 0.0
+
+# Peso de cada fila de una columna de texto, evaluando las reglas una vez por valor distinto
+def peso_columna_texto(serie, reglas, exactas=None):
+    codigos, unicos = pd.factorize(serie)
+    # El último peso corresponde a los nulos (código -1), que se leen como 'nan'
+    pesos = [peso_por_reglas(str(valor).lower(), reglas, exactas) for valor in unicos]
+    pesos.append(peso_por_reglas('nan', reglas, exactas))
+    return np.asarray(pesos, dtype='float64')[codigos]
+
+# Calcula el índice de gravedad de todos los accidentes a la vez, por columnas.
+# Los factores se suman en el mismo orden que el cálculo fila a fila original,
+# así que los resultados son idénticos.
+def calcular_indice_gravedad(df, pesos=pesos_gravedad):
+    gravedad = np.full(len(df), pesos['base'])
     
-    # Factor por diversidad de vehículos
-    if 'diversidad_vehiculos' in row:
-        gravedad += (row['diversidad_vehiculos'] - 1) * 0.15
+    if 'Peatones' in df.columns:
+        gravedad = gravedad + np.where(df['Peatones'].to_numpy() > 0, pesos['peatones'], 0.0)
+    if 'Vehículo de dos ruedas' in df.columns:
+        gravedad = gravedad + np.where(df['Vehículo de dos ruedas'].to_numpy() > 0, pesos['dos_ruedas'], 0.0)
+    if 'Vehículo pesado' in df.columns:
+        gravedad = gravedad + np.where(df['Vehículo pesado'].to_numpy() > 0, pesos['pesado'], 0.0)
+    if 'total_implicados' in df.columns:
+        gravedad = gravedad + (df['total_implicados'].to_numpy(dtype='float64') - 1) * pesos['por_implicado']
+    if 'diversidad_vehiculos' in df.columns:
+        gravedad = gravedad + (df['diversidad_vehiculos'].to_numpy(dtype='float64') - 1) * pesos['por_tipo_vehiculo']
+    if 'tipo_accidente' in df.columns:
+        gravedad = gravedad + peso_columna_texto(df['tipo_accidente'], pesos['tipo_accidente'])
     
-    # Factor por tipo de accidente 
-    if 'tipo_accidente' in row:
-        tipo_acc = str(row['tipo_accidente']).lower()
-        if 'atropello' in tipo_acc:
-            if 'animal' in tipo_acc:
-                gravedad += 1.0  # Atropello a animal es menos grave que a persona
-            else:
-                gravedad += 2.0  # Atropello a persona es muy grave
-        elif 'colisión frontal' in tipo_acc:
-            gravedad += 1.8  # Colisión frontal es muy grave
-        elif 'colisión fronto-lateral' in tipo_acc or 'fronto' in tipo_acc:
-            gravedad += 1.5  # Colisión fronto-lateral es grave
-        elif 'colisión lateral' in tipo_acc:
-            gravedad += 1.2  # Colisión lateral es moderadamente grave
-        elif 'colisión múltiple' in tipo_acc or 'multiple' in tipo_acc:
-            gravedad += 1.7  # Colisión múltiple suele ser grave
-        elif 'alcance' in tipo_acc:
-            gravedad += 1.0  # Alcance es menos grave que otras colisiones
-        elif 'choque' in tipo_acc and 'obstáculo' in tipo_acc:
-            gravedad += 1.3  # Choque contra obstáculo fijo
-        elif 'vuelco' in tipo_acc:
-            gravedad += 1.7  # Vuelco es bastante grave
-        elif 'caída' in tipo_acc or 'caida' in tipo_acc:
-            gravedad += 1.6  # Caída (especialmente para vehículos de dos ruedas)
-        elif ('salida' in tipo_acc and 'vía' in tipo_acc) or 'solo salida' in tipo_acc:
-            gravedad += 1.4  # Salida de vía
-        elif 'despeñamiento' in tipo_acc or 'despen' in tipo_acc:
-            gravedad += 1.9  # Despeñamiento es muy grave
-
-    # Factor por hora del día 
-    if 'dia_hora' in row:
-        hora = pd.to_datetime(row['dia_hora']).hour
-        if 0 <= hora < 6:  # Madrugada (mayor riesgo por fatiga y visibilidad)
-            gravedad += 0.6
-        elif 6 <= hora < 9:  # Hora punta mañana
-            gravedad += 0.4
-        elif 9 <= hora < 17:  # Horario laboral (menor riesgo)
-            gravedad += 0.1
-        elif 17 <= hora < 20:  # Hora punta tarde
-            gravedad += 0.4
-        elif 20 <= hora < 23:  # Noche
-            gravedad += 0.5
+    if 'hora' in df.columns or 'dia_hora' in df.columns:
+        # La hora ya calculada (tabla calendario) o, si no está, la de dia_hora
+        hora = df['hora'].to_numpy() if 'hora' in df.columns else pd.to_datetime(df['dia_hora']).dt.hour.to_numpy()
+        condiciones = [(desde <= hora) & (hora < hasta) for desde, hasta, _ in pesos['hora']]
+        gravedad = gravedad + np.select(condiciones, [peso for _, _, peso in pesos['hora']], default=0.0)
     
-    # Factor por día de la semana 
-    if 'dia_semana' in row:
-        dia = str(row['dia_semana']).lower()
-        if 'viernes' in dia:
-            gravedad += 0.2  # Viernes tarde/noche suele tener accidentes más graves
-        elif 'sábado' in dia or 'sabado' in dia:
-            gravedad += 0.3  # Fin de semana
-        elif 'domingo' in dia:
-            gravedad += 0.3  # Fin de semana
-        elif 'lunes' in dia or 'lun' in dia:
-            gravedad += 0.1  # Lunes tiene ligeramente más accidentes por fatiga post-fin de semana
+    if 'dia_semana' in df.columns:
+        gravedad = gravedad + peso_columna_texto(df['dia_semana'], pesos['dia_semana'])
     
-    # Factor por estado meteorológico
     # Buscamos la columna meteorológica 
-    columna_meteo = None
-    for col in row.index:
-        if 'meteoro' in str(col).lower():
-            columna_meteo = col
-            break
+    columnas_meteo = [col for col in df.columns if 'meteoro' in str(col).lower()]
+    if columnas_meteo:
+        gravedad = gravedad + peso_columna_texto(df[columnas_meteo[0]], pesos['meteo'], pesos['meteo_exacto'])
     
-    if columna_meteo and columna_meteo in row:
-        estado = str(row[columna_meteo]).lower()
-        if estado == 'despejado':
-            gravedad += 0.0  # Condiciones óptimas, no aumenta el riesgo
-        elif 'lluvia débil' in estado or 'lluvia debil' in estado:  
-            gravedad += 0.8  # Lluvia débil aumenta moderadamente el riesgo
-        elif 'lluvia intensa' in estado or 'llubia intensa' in estado:  
-            gravedad += 1.5  # Lluvia intensa aumenta significativamente el riesgo
-        elif 'granizando' in estado or 'granizo' in estado:
-            gravedad += 1.8  # Granizo es muy peligroso para la conducción
-        elif 'nevando' in estado or 'nieve' in estado:
-            gravedad += 2.0  # Nieve es extremadamente peligrosa
-        elif 'nublado' in estado:
-            gravedad += 0.3  # Nublado reduce ligeramente la visibilidad
-            
-    return round(gravedad, 2)
+    # Redondeo con round() de Python una vez por valor distinto (igual que el cálculo original)
+    unicos, inverso = np.unique(gravedad, return_inverse=True)
+    return np.array([round(valor, 2) for valor in unicos])[inverso]
 
 # 9. CREACIÓN DEL DATASET FINAL
 
-# Primero, contamos los tipos de personas por expediente
-conteo_personas = df_2020.groupby(['num_expediente', 'tipo_persona']).size().unstack(fill_value=0)
-
-
-for tipo in ['Conductor', 'Pasajero', 'Peatón']:
-    if tipo not in conteo_personas.columns:
-        conteo_personas[tipo] = 0
-
-# Renombramos las columnas para mayor claridad
-conteo_personas.columns = ['Conductores', 'Pasajeros', 'Peatones']
-
-# Contamos los tipos de vehículos por expediente
-# Filtramos solo los conductores para contar vehículos (sin pasajeros y sin peatones)
-df_vehiculos = df_2020[df_2020['tipo_persona'] == 'Conductor']
-# Contamos cuántos vehículos de cada tipo hay en cada expediente
-conteo_vehiculos = df_vehiculos.groupby(['num_expediente', 'tipo_vehiculo']).size().unstack(fill_value=0)
-
-# Creamos categorías generales de vehículos con valores iniciales de 0
-conteo_vehiculos['Vehículo de dos ruedas'] = 0
-conteo_vehiculos['Vehículo pesado'] = 0
-conteo_vehiculos['Otros vehículos'] = 0
-
-# Asignamos directamente los valores de la columna "Turismo" original - Para evitar duplicidad de los datos
-if "Turismo" in conteo_vehiculos.columns:
-    # Guardamos los valores originales de la columna Turismo
-    turismo_values = conteo_vehiculos["Turismo"].copy()
-    # Creamos la columna de categoría
-    conteo_vehiculos['Turismo'] = turismo_values
-
-
-# Clasificamos los vehículos en categorías generales
-for col in conteo_vehiculos.columns:
-    col_lower = str(col).lower()
-    # Saltamos las columnas de categorías generales
-    if col in ['Vehículo de dos ruedas', 'Vehículo pesado', 'Turismo', 'Otros vehículos']:
-        continue
-    
-    # Vehículos de dos ruedas
-    if ('moto' in col_lower or 'ciclomotor' in col_lower or 'bicicleta' in col_lower or
-        'ciclo' in col_lower or 'patinete' in col_lower or 'vmu' in col_lower or
-        'epac' in col_lower or 'tres ruedas' in col_lower):
-        conteo_vehiculos['Vehículo de dos ruedas'] += conteo_vehiculos[col]
-    
-    # Vehículos pesados
-    elif ('camión' in col_lower or 'camion' in col_lower or 'autobús' in col_lower or 
-          'autobus' in col_lower or 'emt' in col_lower or 'tractocamión' in col_lower or
-          'articulado' in col_lower or 'remolque' in col_lower or 'semiremolque' in col_lower or
-          'bomberos' in col_lower or 'ambulancia' in col_lower or 'maquinaria' in col_lower):
-        conteo_vehiculos['Vehículo pesado'] += conteo_vehiculos[col]
-    
-    # Turismos (ya establecidos separadamente anteriormente, pero por si acaso)
-    elif 'turismo' in col_lower or 'todo terreno' in col_lower or 'autocaravana' in col_lower:
-        conteo_vehiculos['Turismo'] += conteo_vehiculos[col]
-    
-    # Otros vehículos
-    else:
-        conteo_vehiculos['Otros vehículos'] += conteo_vehiculos[col]
-
+# Categorías generales de vehículos. Cada tipo de vehículo se clasifica una sola vez
+# (la primera regla cuyo texto aparezca en el tipo) y el resultado se aplica a los
+# códigos de la columna, así los tipos nuevos no añaden columnas al conteo.
+categorias_vehiculo = ['Turismo', 'Vehículo de dos ruedas', 'Vehículo pesado', 'Otros vehículos']
+reglas_vehiculo = [
+    ('Vehículo de dos ruedas', ['moto', 'ciclomotor', 'bicicleta', 'ciclo', 'patinete', 'vmu', 'epac', 'tres ruedas']),
+    ('Vehículo pesado', ['camión', 'camion', 'autobús', 'autobus', 'emt', 'tractocamión', 'articulado',
+                         'remolque', 'semiremolque', 'bomberos', 'ambulancia', 'maquinaria']),
+    ('Turismo', ['turismo', 'todo terreno', 'autocaravana']),
+]
 
-# Creamos un dataset base con un registro único por expediente
+# Función para asignar la categoría general a un tipo de vehículo
+def categoria_vehiculo(tipo):
+    tipo_lower = str(tipo).lower()
+    for categoria, patrones in reglas_vehiculo:
+        if any(patron in tipo_lower for patron in patrones):
+            return categoria
+    return 'Otros vehículos'
+
+tipos_persona = ['Conductor', 'Pasajero', 'Peatón']
+columnas_personas = ['Conductores', 'Pasajeros', 'Peatones']
+
+# Contamos personas y vehículos por expediente en una sola pasada: cada fila suma 1
+# a su tipo de persona y, si es conductor, 1 a la categoría de su vehículo
+# (sin pasajeros y sin peatones). Los conteos quedan en una matriz expediente x columna.
+codigos_expediente, expedientes = pd.factorize(df_2020['num_expediente'])
+codigo_persona = pd.Index(tipos_persona).get_indexer(df_2020['tipo_persona'])
+codigos_tipo, tipos_vehiculo = pd.factorize(df_2020['tipo_vehiculo'])
+categoria_por_tipo = pd.Index(categorias_vehiculo).get_indexer([categoria_vehiculo(tipo) for tipo in tipos_vehiculo])
+codigo_vehiculo = np.where((codigo_persona == 0) & (codigos_tipo >= 0),
+                           len(tipos_persona) + categoria_por_tipo[codigos_tipo], -1)
+
+columnas_conteo = columnas_personas + categorias_vehiculo
+etiquetas = np.concatenate([codigo_persona, codigo_vehiculo])
+filas = np.concatenate([codigos_expediente, codigos_expediente])
+validas = (etiquetas >= 0) & (filas >= 0)
+conteos = np.bincount(filas[validas] * len(columnas_conteo) + etiquetas[validas],
+                      minlength=len(expedientes) * len(columnas_conteo)).reshape(len(expedientes), len(columnas_conteo))
+print(f"\nTipos de vehículo por categoría: {pd.Series(categoria_por_tipo).map(dict(enumerate(categorias_vehiculo))).value_counts().to_dict()}")
+
+# Creamos un dataset base con un registro único por expediente y le añadimos los conteos
+# (la última fila de ceros es para los expedientes vacíos)
 df_base = df_2020.drop_duplicates(subset=['num_expediente'])
+posiciones = expedientes.get_indexer(df_base['num_expediente'])
+conteos = np.vstack([conteos, np.zeros((1, len(columnas_conteo)), dtype=conteos.dtype)])
+df_final = df_base.copy()
+df_final[columnas_conteo] = conteos[posiciones]
 
-# Unimos la información de personas y vehículos al dataset base
-df_final = df_base.merge(conteo_personas, left_on='num_expediente', right_index=True, how='left')
-
-# Seleccionamos las columnas de vehículos que hemos creado
-columnas_vehiculos = [col for col in conteo_vehiculos.columns if col in ['Vehículo de dos ruedas', 'Vehículo pesado', 'Turismo', 'Otros vehículos']]
-print(f"\nColumnas de vehículos seleccionadas: {columnas_vehiculos}")
-
-# Realizamos la unión
-df_final = df_final.merge(conteo_vehiculos[columnas_vehiculos], left_on='num_expediente', right_index=True, how='left')
-
-# Rellenamos los NaN con 0
-df_final = df_final.fillna(0)
+# Rellenamos los NaN con 0 en las columnas numéricas (las de texto se quedan vacías:
+# un 0 en medio de una columna de texto no se puede guardar en Parquet)
+columnas_numericas = df_final.select_dtypes(include='number').columns
+df_final[columnas_numericas] = df_final[columnas_numericas].fillna(0)
 
 # Calculamos métricas adicionales
 df_final['total_implicados'] = df_final['Conductores'] + df_final['Pasajeros'] + df_final['Peatones']
@@ -335,38 +367,27 @@ df_final['diversidad_vehiculos'] = ((df_final['Vehículo de dos ruedas'] > 0).as
                                    (df_final['Vehículo pesado'] > 0).astype(int) + 
                                    (df_final['Turismo'] > 0).astype(int) + 
                                    (df_final['Otros vehículos'] > 0).astype(int))
+df_final = aplicar_tipos(df_final, etapa='03 dataset por expediente')
 
 # 10. APLICACIÓN DEL ÍNDICE DE GRAVEDAD
 # Calculamos el índice de gravedad para cada accidente
-df_final['indice_gravedad'] = df_final.apply(calcular_indice_gravedad, axis=1)
+df_final['indice_gravedad'] = calcular_indice_gravedad(df_final)
 
 # Creamos categorías de gravedad (bajo, medio, alto)
 df_final['categoria_gravedad'] = pd.qcut(df_final['indice_gravedad'], 3, labels=['Bajo', 'Medio', 'Alto'])
 
 # 11. ANÁLISIS DE GRAVEDAD POR DISTRITO
 
-gravedad_por_distrito = df_final.groupby('distrito')['indice_gravedad'].mean().sort_values(ascending=False)
+gravedad_por_distrito = df_final.groupby('distrito', observed=True)['indice_gravedad'].mean().sort_values(ascending=False)
 
 # 12. ANÁLISIS DE GRAVEDAD POR TIPO DE ACCIDENTE
-gravedad_por_tipo = df_final.groupby('tipo_accidente')['indice_gravedad'].mean().sort_values(ascending=False)
+gravedad_por_tipo = df_final.groupby('tipo_accidente', observed=True)['indice_gravedad'].mean().sort_values(ascending=False)
 
 # 13. ANÁLISIS DE GRAVEDAD POR HORA DEL DÍA
 # Extraemos la hora del día
 try:
-    df_final['hora'] = pd.to_datetime(df_final['dia_hora']).dt.hour
-    # Definimos franjas horarias
-    def get_franja_horaria(hora):
-        if 6 <= hora < 12:
-            return 'Mañana'
-        elif 12 <= hora < 18:
-            return 'Tarde'
-        elif 18 <= hora < 22:
-            return 'Noche'
-        else:
-            return 'Madrugada'
-    
-    df_final['franja_horaria'] = df_final['hora'].apply(get_franja_horaria)
-    gravedad_por_franja = df_final.groupby('franja_horaria')['indice_gravedad'].mean()
+    # La hora y la franja horaria ya vienen de la tabla calendario (sección 4)
+    gravedad_por_franja = df_final.groupby('franja_horaria', observed=True)['indice_gravedad'].mean()
     # Reordenamos
     try:
         gravedad_por_franja = gravedad_por_franja.reindex(['Mañana', 'Tarde', 'Noche', 'Madrugada'])
@@ -379,49 +400,75 @@ except Exception as e:
 # 14. GUARDADO DE RESULTADOS
 
 # Definimos la ruta donde guardar los resultados - DIRECTAMENTE EN LA CARPETA DEL PROYECTO
-ruta_resultados = r'C:\Users\afono\Desktop\TFM - ALBERT FONOLLET TORRUBIANO\TFM_Kschool\resultados'
+ruta_resultados = os.environ.get('TFM_RUTA_RESULTADOS', r'C:\Users\afono\Desktop\TFM - ALBERT FONOLLET TORRUBIANO\TFM_Kschool\resultados')
+
+# Los datasets se guardan en Parquet (rápido, con tipos y sin límite de filas).
+# El Excel de agregaciones es solo un resumen para consultar y se puede desactivar con TFM_EXCEL=0
+guardar_excel = os.environ.get('TFM_EXCEL', '1') == '1'
+
+# Modo incremental (TFM_INCREMENTAL=1): el archivo de entrada es un lote nuevo de
+# expedientes (TFM_RUTA_LOTE). Sus agregados se suman a los acumulados en SQLite y
+# las tablas que se exportan son las acumuladas. Sin este modo, los acumulados se
+# reconstruyen con el histórico completo.
+ruta_agregados = os.environ.get('TFM_RUTA_AGREGADOS', os.path.join(ruta_resultados, 'agregados.sqlite'))
 
 # Aplicamos la corrección de caracteres mal codificados a los resultados finales
 
-# Función para corregir todo el DataFrame una vez más
+# Reemplazos para corregir todo el DataFrame una vez más
+reemplazos_finales = {
+    'MaÃ±ana': 'Mañana',
+    'ColisiÃ³n lateral': 'Colisión lateral',
+    'ColisiÃ³n fronto-lateral': 'Colisión fronto-lateral',
+    'ColisiÃ³n frontal': 'Colisión frontal',
+    'Choque contra obstÃ¡culo fijo': 'Choque contra obstáculo fijo',
+    'Solo salida de la vÃ­a': 'Solo salida de la vía',
+    'MiÃ©rcoles': 'Miércoles',
+    'CHAMBERÃ': 'CHAMBERÍ',
+    'CHAMARTÃN': 'CHAMARTÍN',
+    'CaÃ­da': 'Caída',
+    'CamiÃ³n rÃ­gido': 'Camión rígido',
+    'Ã±': 'ñ',
+    'Ã¡': 'á',
+    'Ã©': 'é',
+    'Ã­': 'í',
+    'Ã³': 'ó',
+    'Ãº': 'ú'
+}
+
+def corregir_texto_final(texto):
+    if not isinstance(texto, str):
+        return texto
+    for patron, reemplazo in reemplazos_finales.items():
+        texto = re.sub(patron, reemplazo, texto)
+    return texto
+
+# Función para corregir todo el DataFrame una vez más.
+# Solo se tocan las columnas de texto (una vez por valor distinto), de modo que las
+# columnas numéricas y de fecha conservan su tipo sin convertirlas a texto y de vuelta.
 def corregir_df_final(df):
-    # Convertir todo el DataFrame a string para procesamiento
-    df_str = df.astype(str)
-    
-    # Reemplazar directamente en todo el DataFrame
-    df_corregido = df_str.replace({
-        'MaÃ±ana': 'Mañana',
-        'ColisiÃ³n lateral': 'Colisión lateral',
-        'ColisiÃ³n fronto-lateral': 'Colisión fronto-lateral',
-        'ColisiÃ³n frontal': 'Colisión frontal',
-        'Choque contra obstÃ¡culo fijo': 'Choque contra obstáculo fijo',
-        'Solo salida de la vÃ­a': 'Solo salida de la vía',
-        'MiÃ©rcoles': 'Miércoles',
-        'CHAMBERÃ': 'CHAMBERÍ',
-        'CHAMARTÃN': 'CHAMARTÍN',
-        'CaÃ­da': 'Caída',
-        'CamiÃ³n rÃ­gido': 'Camión rígido',
-        'Ã±': 'ñ',
-        'Ã¡': 'á',
-        'Ã©': 'é',
-        'Ã­': 'í',
-        'Ã³': 'ó',
-        'Ãº': 'ú'
-    }, regex=True)
-    
-    # Restaurar los tipos de datos originales donde sea posible
-    for col in df.columns:
-        if df[col].dtype != 'object':
-            try:
-                df_corregido[col] = df_corregido[col].astype(df[col].dtype)
-            except:
-                pass
-    
-    return df_corregido
+    for columna in df.select_dtypes(include=['object', 'string', 'category']).columns:
+        df[columna] = corregir_por_valor(df[columna], corregir_texto_final)
+    return df
 
 # Aplicar la corrección directa
+df_final = aplicar_tipos(df_final)
 df_final = corregir_df_final(df_final)
 
+# Actualizamos los agregados acumulados y usamos sus tablas en lugar de las del lote
+conexion_agregados = abrir_agregados(ruta_agregados)
+if not modo_incremental:
+    vaciar_agregados(conexion_agregados)
+nuevos = actualizar_agregados(conexion_agregados, df_final)
+print(f"\nAgregados acumulados ({ruta_agregados}): {nuevos} expedientes nuevos de {df_final['num_expediente'].nunique()}")
+if modo_incremental:
+    tablas = tablas_agregadas(conexion_agregados)
+    accidentes_por_distrito = agrupar_distritos(tablas['accidentes_por_distrito'])
+    accidentes_por_tipo = tablas['accidentes_por_tipo']
+    gravedad_por_distrito = tablas['gravedad_por_distrito']
+    gravedad_por_tipo = tablas['gravedad_por_tipo']
+    gravedad_por_franja = tablas['gravedad_por_franja']
+conexion_agregados.close()
+
 # Seleccionamos solo las columnas relevantes para el modelo de predicción
 columnas_relevantes = [
     'num_expediente',          # Identificador único
@@ -452,139 +499,297 @@ if len(columnas_existentes) < len(columnas_relevantes):
     print(f"Columnas no encontradas: {columnas_faltantes}")
 
 # Seleccionamos solo las columnas existentes
-df_final_limpio = df_final[columnas_existentes]
+# (el texto y la fecha llegan del Arrow con tipos de Arrow: se guardan con los tipos
+# de pandas de siempre; hay una fila por expediente, así que la copia es pequeña)
+tipos_pandas = {'num_expediente': 'str', 'dia_hora': 'datetime64[us]'}
+df_final_limpio = df_final[columnas_existentes].astype(
+    {columna: tipo for columna, tipo in tipos_pandas.items() if columna in columnas_existentes})
 print(f"Dimensiones del dataset final: {df_final_limpio.shape}")
 
-# Guardamos el dataset final en formato Excel
-print("\nGuardando dataset final en formato Excel...")
-df_final_limpio.to_excel(os.path.join(ruta_resultados, 'df_2020_final_con_gravedad.xlsx'), index=False)
-print(f"Dataset final guardado en: {os.path.join(ruta_resultados, 'df_2020_final_con_gravedad.xlsx')}")
+# Guardamos el dataset final en formato Parquet
+print("\nGuardando dataset final en formato Parquet...")
+# (en modo incremental solo contiene el lote, así que se guarda con otro nombre)
+nombre_dataset_final = 'lote_con_gravedad.parquet' if modo_incremental else 'df_2020_final_con_gravedad.parquet'
+df_final_limpio.to_parquet(os.path.join(ruta_resultados, nombre_dataset_final), index=False)
+print(f"Dataset final guardado en: {os.path.join(ruta_resultados, nombre_dataset_final)}")
 
 # Guardamos las agregaciones principales en un solo archivo Excel con múltiples hojas
-with pd.ExcelWriter(os.path.join(ruta_resultados, 'agregaciones.xlsx')) as writer:
-    accidentes_por_distrito.to_excel(writer, sheet_name='Agregados_Distrito', index=False)
-    gravedad_por_distrito.to_frame().to_excel(writer, sheet_name='Gravedad_Distrito')
-    gravedad_por_tipo.to_frame().to_excel(writer, sheet_name='Gravedad_Tipo')
-    
-    # Guardamos también la agregación por franja horaria
-    if 'gravedad_por_franja' in locals():
-        # Aseguramos que los índices (nombres de franjas) estén correctamente codificados
-        gravedad_por_franja.index = gravedad_por_franja.index.map(lambda x: corregir_encoding(x) if isinstance(x, str) else x)
-        gravedad_por_franja.to_frame().to_excel(writer, sheet_name='Gravedad_Franja')
+if guardar_excel:
+    with pd.ExcelWriter(os.path.join(ruta_resultados, 'agregaciones.xlsx')) as writer:
+        accidentes_por_distrito.to_excel(writer, sheet_name='Agregados_Distrito', index=False)
+        accidentes_por_tipo.to_frame().to_excel(writer, sheet_name='Agregados_Tipo')
+        gravedad_por_distrito.to_frame().to_excel(writer, sheet_name='Gravedad_Distrito')
+        gravedad_por_tipo.to_frame().to_excel(writer, sheet_name='Gravedad_Tipo')
+        
+        # Guardamos también la agregación por franja horaria
+        if 'gravedad_por_franja' in locals():
+            # Aseguramos que los índices (nombres de franjas) estén correctamente codificados
+            gravedad_por_franja.index = gravedad_por_franja.index.map(lambda x: corregir_encoding(x) if isinstance(x, str) else x)
+            gravedad_por_franja.to_frame().to_excel(writer, sheet_name='Gravedad_Franja')
+    print(f"Agregaciones guardadas en: {os.path.join(ruta_resultados, 'agregaciones.xlsx')}")
 
-print(f"\nTodos los archivos guardados en formato Excel en: {ruta_resultados}")
+print(f"\nTodos los archivos guardados en: {ruta_resultados}")
 
 # 15. GENERACIÓN DE DATOS DE NO ACCIDENTES PARA EL MODELO DE PREDICCIÓN
 
-def generar_no_accidentes(df_accidentes, factor_multiplicador=5):
+# Muestreo de celdas vacías de la rejilla distrito × fecha × franja horaria. Cada
+# celda se identifica con una clave entera y las ocupadas por algún accidente se
+# guardan en un índice hash. Los candidatos se sortean dentro de
+# cada estrato y se descartan los ocupados o repetidos, así que la rejilla completa
+# nunca se construye en memoria (sirve igual para rejillas por hora y de varios años).
+# `pesos_estrato` da más o menos peso a cada estrato (franja horaria o distrito) al
+# repartir las `n` celdas; sin pesos se reparten en proporción a las celdas vacías.
+# Con nivel='hora' la rejilla es distrito × fecha × hora, pero la ocupación se sigue
+# comprobando por franja (una hora está ocupada si su franja tiene algún accidente),
+# de modo que ningún registro sintético cae en una franja con un accidente real.
+# Si por franja no hay celdas vacías para las `n` pedidas, se muestrea por hora
+# (varias horas de una misma franja vacía); si tampoco bastan, se avisa y se
+# devuelven todas las que hay.
+def muestrear_celdas_vacias(df_accidentes, n, semilla=None, nivel='franja', estrato='franja_horaria',
+                            pesos_estrato=None, tamano_lote=100_000):
+    rng = np.random.default_rng(semilla)
     
-    #Generamos datos sintéticos de no accidentes basados en los datos de accidentes existentes
-
-    # Creamos un DataFrame vacío para los no accidentes
-    no_accidentes = []
+    # Ejes de la rejilla
+    distritos = pd.Index(sorted(df_accidentes['distrito'].dropna().unique()))
+    fechas = pd.to_datetime(df_accidentes['dia_hora'])
+    fecha_inicial = fechas.min().normalize()
+    n_fechas = (fechas.max().normalize() - fecha_inicial).days + 1
+    
+    # Celdas (distrito, fecha, franja) ocupadas por algún accidente
+    distrito_accidentes = distritos.get_indexer(df_accidentes['distrito'])
+    fecha_accidentes = (fechas.dt.normalize() - fecha_inicial).dt.days.to_numpy()
+    franja_accidentes = pd.Index(FRANJAS).get_indexer(df_accidentes['franja_horaria'])
+    validas = (distrito_accidentes >= 0) & (franja_accidentes >= 0)
+    claves = (distrito_accidentes * n_fechas + fecha_accidentes) * len(FRANJAS) + franja_accidentes
+    ocupadas_franja = np.unique(claves[validas])
+    
+    niveles = ['franja', 'hora'] if nivel == 'franja' else ['hora']
+    for nivel_rejilla in niveles:
+        # Tramos de tiempo de la rejilla (franjas u horas) y franja de cada tramo
+        if nivel_rejilla == 'franja':
+            franja_por_tiempo = np.array(FRANJAS, dtype=object)
+        else:
+            franja_por_tiempo = franja_de_hora(np.arange(24))
+        n_tiempos = len(franja_por_tiempo)
+        
+        # Índice hash de celdas ocupadas: todos los tramos de las franjas ocupadas
+        dia_ocupadas = ocupadas_franja // len(FRANJAS)
+        franja_ocupadas = ocupadas_franja % len(FRANJAS)
+        ocupadas = pd.Index(np.sort(np.concatenate([
+            dia_ocupadas[franja_ocupadas == i] * n_tiempos + tiempo
+            for i, nombre in enumerate(FRANJAS) for tiempo in np.flatnonzero(franja_por_tiempo == nombre)])))
+        distrito_ocupadas = ocupadas.to_numpy() // (n_fechas * n_tiempos)
+        tiempo_ocupadas = ocupadas.to_numpy() % n_tiempos
+        
+        # Estratos: valores de distrito y de tiempo que abarca cada uno
+        if estrato == 'distrito':
+            estratos = {nombre: (np.array([i]), np.arange(n_tiempos)) for i, nombre in enumerate(distritos)}
+            ocupadas_estrato = {nombre: int((distrito_ocupadas == i).sum()) for i, nombre in enumerate(distritos)}
+        else:
+            estratos = {nombre: (np.arange(len(distritos)), np.flatnonzero(franja_por_tiempo == nombre))
+                        for nombre in FRANJAS}
+            ocupadas_estrato = {nombre: int(np.isin(tiempo_ocupadas, estratos[nombre][1]).sum())
+                                for nombre in FRANJAS}
+        vacias = {nombre: len(ds_) * n_fechas * len(ts_) - ocupadas_estrato[nombre]
+                  for nombre, (ds_, ts_) in estratos.items()}
+        
+        # Reparto de las n celdas entre estratos (cada uno como mucho con sus celdas vacías)
+        pesos = {nombre: (pesos_estrato or {}).get(nombre, 1.0) * vacias[nombre] for nombre in estratos}
+        total_pesos = sum(pesos.values())
+        if total_pesos == 0 and n > 0:
+            raise ValueError(f"No hay celdas vacías (con peso mayor que cero) en la rejilla de "
+                             f"{len(distritos)} distritos x {n_fechas} días para muestrear {n} registros")
+        cuotas = {nombre: n * pesos[nombre] / total_pesos if total_pesos else 0 for nombre in estratos}
+        pedidas = {nombre: int(cuota) for nombre, cuota in cuotas.items()}
+        # Lo que queda por el redondeo va a los estratos con mayor parte decimal
+        restos = sorted(estratos, key=lambda nombre: cuotas[nombre] - pedidas[nombre], reverse=True)
+        for nombre in restos[:n - sum(pedidas.values())]:
+            pedidas[nombre] += 1
+        objetivos = {nombre: min(vacias[nombre], pedidas[nombre]) for nombre in estratos}
+        faltan = n - sum(objetivos.values())
+        print(f"Rejilla de {len(distritos)} distritos x {n_fechas} días x {n_tiempos} tramos: "
+              f"{len(ocupadas)} celdas ocupadas, {sum(vacias.values())} vacías, se muestrean {sum(objetivos.values())}.")
+        if faltan == 0:
+            break
+        if nivel_rejilla == 'franja':
+            print(f"Faltan {faltan} celdas vacías por franja: se muestrea por hora.")
+        else:
+            print(f"Aviso: solo se pueden muestrear {sum(objetivos.values())} de las {n} celdas pedidas "
+                  f"(faltan {faltan}).")
+    
+    partes = []
+    for nombre, (ds_, ts_) in estratos.items():
+        elegidas = np.empty(0, dtype=np.int64)
+        while len(elegidas) < objetivos[nombre]:
+            m = min(tamano_lote, max(1000, 2 * (objetivos[nombre] - len(elegidas))))
+            candidatas = ((rng.choice(ds_, m) * n_fechas + rng.integers(0, n_fechas, m)) * n_tiempos
+                          + rng.choice(ts_, m))
+            candidatas = candidatas[ocupadas.get_indexer(candidatas) == -1]
+            elegidas = pd.unique(np.concatenate([elegidas, candidatas]))[:objetivos[nombre]]
+        partes.append(elegidas)
+    claves = rng.permutation(np.concatenate(partes))
+    
+    tiempo = claves % n_tiempos
+    celdas = pd.DataFrame({
+        'distrito': pd.Categorical.from_codes(claves // (n_fechas * n_tiempos), categories=distritos),
+        'fecha': fecha_inicial + pd.to_timedelta((claves // n_tiempos) % n_fechas, unit='D'),
+        'franja_horaria': pd.Categorical(franja_por_tiempo[tiempo], categories=FRANJAS),
+    })
+    if nivel_rejilla == 'hora':
+        celdas['hora'] = tiempo.astype(np.int8)
+    return celdas
+# Generamos datos sintéticos de no accidentes basados en los datos de accidentes existentes.
+# Todas las variables de un bloque se sortean a la vez con el generador `rng`, así que
+# con la misma semilla (y el mismo tamaño de bloque) se obtienen siempre los mismos
+# registros. Se generan por bloques de `tamano_bloque` filas con tipos compactos para
+# que factores grandes (10-50) quepan en memoria.
+# Si se pasan `celdas` (ver muestrear_celdas_vacias) se genera un registro por celda,
+# usando su distrito, fecha y franja (u hora) en lugar de sortearlos; el número de
+# registros es entonces el de celdas y `factor_multiplicador` no se usa (el factor se
+# aplica al pedir las celdas).
+def iterar_no_accidentes(df_accidentes, factor_multiplicador=5, semilla=None, tamano_bloque=200_000,
+                         celdas=None):
+    rng = np.random.default_rng(semilla)
     
     # Obtenemos distribuciones de variables clave
     distritos = df_accidentes['distrito'].value_counts(normalize=True)
-    franjas_horarias = df_accidentes['franja_horaria'].value_counts(normalize=True) if 'franja_horaria' in df_accidentes.columns else None
+    if 'franja_horaria' in df_accidentes.columns:
+        franjas_horarias = df_accidentes['franja_horaria'].value_counts(normalize=True)
+    else:
+        # Si no hay franjas horarias, se sortean con la misma probabilidad
+        franjas_horarias = pd.Series(0.25, index=['Mañana', 'Tarde', 'Noche', 'Madrugada'])
     estados_meteo = df_accidentes['estado_meteorológico'].value_counts(normalize=True)
     
-    # Generamos registros de no accidentes
-    num_no_accidentes = len(df_accidentes) * factor_multiplicador
+    # Rango de fechas de los datos originales (se calcula una sola vez)
+    fechas = pd.to_datetime(df_accidentes['dia_hora'])
+    fecha_min = fechas.min()
+    dias_rango = (fechas.max() - fecha_min).days
+    # Día inicial a las 00:00 (conservando los segundos, como al hacer replace(hour, minute))
+    dia_inicial = fecha_min - pd.Timedelta(hours=fecha_min.hour, minutes=fecha_min.minute)
+    
+    num_no_accidentes = len(df_accidentes) * factor_multiplicador if celdas is None else len(celdas)
     print(f"Generando {num_no_accidentes} registros de no accidentes...")
     
-    for i in range(num_no_accidentes):
-        # Generamos un registro con distribuciones similares pero variaciones aleatorias
-        distrito = np.random.choice(distritos.index, p=distritos.values)
+    for inicio in range(0, num_no_accidentes, tamano_bloque):
+        n = min(tamano_bloque, num_no_accidentes - inicio)
         
-        if franjas_horarias is not None:
-            franja = np.random.choice(franjas_horarias.index, p=franjas_horarias.values)
+        hora = None
+        if celdas is None:
+            distrito = pd.Categorical.from_codes(rng.choice(len(distritos), size=n, p=distritos.to_numpy()),
+                                                 categories=distritos.index)
+            franja = pd.Categorical.from_codes(rng.choice(len(franjas_horarias), size=n, p=franjas_horarias.to_numpy()),
+                                               categories=franjas_horarias.index)
+            # Día aleatorio dentro del mismo rango que los datos originales
+            dia = dia_inicial + pd.to_timedelta(rng.integers(0, dias_rango, n), unit='D')
         else:
-            # Si no hay franjas horarias, generamos una aleatoria
-            franja = np.random.choice(['Mañana', 'Tarde', 'Noche', 'Madrugada'])
-            
-        estado_meteo = np.random.choice(estados_meteo.index, p=estados_meteo.values)
+            celdas_bloque = celdas.iloc[inicio:inicio + n]
+            distrito = celdas_bloque['distrito'].array
+            franja = celdas_bloque['franja_horaria'].array
+            dia = pd.DatetimeIndex(celdas_bloque['fecha'])
+            if 'hora' in celdas_bloque.columns:
+                hora = celdas_bloque['hora'].to_numpy()
+        estado_meteo = rng.choice(len(estados_meteo), size=n, p=estados_meteo.to_numpy())
         
-        # Generamos una fecha/hora aleatoria dentro del mismo rango que los datos originales
-        fecha_min = pd.to_datetime(df_accidentes['dia_hora']).min()
-        fecha_max = pd.to_datetime(df_accidentes['dia_hora']).max()
-        dias_rango = (fecha_max - fecha_min).days
-        fecha_aleatoria = fecha_min + pd.Timedelta(days=np.random.randint(0, dias_rango))
+        # Ajustamos la hora según la franja horaria (lo que no sea mañana, tarde o noche es madrugada)
+        if hora is None:
+            nombres_franja = np.asarray(franja)
+            hora = np.where(rng.random(n) < 0.5, rng.integers(22, 24, n), rng.integers(0, 6, n))
+            for nombre, (desde, hasta) in HORAS_POR_FRANJA.items():
+                en_franja = nombres_franja == nombre
+                hora[en_franja] = rng.integers(desde, hasta, en_franja.sum())
         
-        # Ajustamos la hora según la franja horaria
-        if franja == 'Mañana':
-            hora = np.random.randint(6, 12)
-        elif franja == 'Tarde':
-            hora = np.random.randint(12, 18)
-        elif franja == 'Noche':
-            hora = np.random.randint(18, 22)
-        else:  # Madrugada
-            hora = np.random.randint(22, 24) if np.random.random() < 0.5 else np.random.randint(0, 6)
+        dia_hora = (dia
+                    + pd.to_timedelta(hora, unit='h')
+                    + pd.to_timedelta(rng.integers(0, 60, n), unit='min'))
         
-        fecha_aleatoria = fecha_aleatoria.replace(hour=hora, minute=np.random.randint(0, 60))
-        
-        # Creamos el registro
-        registro = {
-            'num_expediente': f'NA{i:06d}',  # NA = No Accidente
-            'dia_hora': fecha_aleatoria,
+        bloque = pd.DataFrame({
+            'num_expediente': 'NA' + pd.Series(np.arange(inicio, inicio + n)).astype(str).str.zfill(6),  # NA = No Accidente
+            'dia_hora': dia_hora,
             'distrito': distrito,
-            'estado_meteorológico': estado_meteo,
-            'Conductores': np.random.randint(1, 4),  # Simulamos tráfico normal
-            'Pasajeros': np.random.randint(0, 3),
-            'Peatones': np.random.randint(0, 2),
-            'Vehículo de dos ruedas': np.random.binomial(1, 0.3),  # 30% de probabilidad
-            'Vehículo pesado': np.random.binomial(1, 0.1),  # 10% de probabilidad
-            'Turismo': np.random.binomial(1, 0.8),  # 80% de probabilidad
-            'Otros vehículos': np.random.binomial(1, 0.05),  # 5% de probabilidad
-        }
+            'estado_meteorológico': pd.Categorical.from_codes(estado_meteo, categories=estados_meteo.index),
+            'Conductores': rng.integers(1, 4, n, dtype=np.int8),  # Simulamos tráfico normal
+            'Pasajeros': rng.integers(0, 3, n, dtype=np.int8),
+            'Peatones': rng.integers(0, 2, n, dtype=np.int8),
+            'Vehículo de dos ruedas': rng.binomial(1, 0.3, n).astype(np.int8),  # 30% de probabilidad
+            'Vehículo pesado': rng.binomial(1, 0.1, n).astype(np.int8),  # 10% de probabilidad
+            'Turismo': rng.binomial(1, 0.8, n).astype(np.int8),  # 80% de probabilidad
+            'Otros vehículos': rng.binomial(1, 0.05, n).astype(np.int8),  # 5% de probabilidad
+        })
         
         # Calculamos métricas adicionales
-        registro['total_implicados'] = registro['Conductores'] + registro['Pasajeros'] + registro['Peatones']
-        registro['tiene_vulnerables'] = 1 if registro['Peatones'] > 0 else 0
-        registro['diversidad_vehiculos'] = (registro['Vehículo de dos ruedas'] + 
-                                           registro['Vehículo pesado'] + 
-                                           registro['Turismo'] + 
-                                           registro['Otros vehículos'])
-        registro['franja_horaria'] = franja
+        bloque['total_implicados'] = bloque['Conductores'] + bloque['Pasajeros'] + bloque['Peatones']
+        bloque['tiene_vulnerables'] = (bloque['Peatones'] > 0).astype(np.int8)
+        bloque['diversidad_vehiculos'] = (bloque['Vehículo de dos ruedas'] + 
+                                          bloque['Vehículo pesado'] + 
+                                          bloque['Turismo'] + 
+                                          bloque['Otros vehículos'])
+        bloque['franja_horaria'] = franja
         
-        no_accidentes.append(registro)
-    
-    # Convertimos a DataFrame
-    df_no_accidentes = pd.DataFrame(no_accidentes)
-    
-    # Añadimos columnas necesarias para compatibilidad
-    if 'indice_gravedad' in df_accidentes.columns:
-        df_no_accidentes['indice_gravedad'] = 0  # No hay gravedad en los no-accidentes
-    if 'categoria_gravedad' in df_accidentes.columns:
-        df_no_accidentes['categoria_gravedad'] = 'Ninguno'  # No hay categoría de gravedad
+        # Añadimos columnas necesarias para compatibilidad
+        if 'indice_gravedad' in df_accidentes.columns:
+            bloque['indice_gravedad'] = 0  # No hay gravedad en los no-accidentes
+        if 'categoria_gravedad' in df_accidentes.columns:
+            bloque['categoria_gravedad'] = 'Ninguno'  # No hay categoría de gravedad
         
-    return df_no_accidentes
-
-# Después de guardar el dataset final de accidentes
-print("\nPreparando dataset para modelo de predicción...")
-
-# Añadimos la etiqueta de accidente a los datos originales
-df_final_con_etiqueta = df_final_limpio.copy()
-df_final_con_etiqueta['es_accidente'] = 1
-
-# Generamos datos de no accidentes (factor 5 para representar mejor la realidad, tambien previamente definido)
-df_no_accidentes = generar_no_accidentes(df_final_con_etiqueta, factor_multiplicador=3)
-df_no_accidentes['es_accidente'] = 0  # Variable para no accidentes
-
-# Combinamos ambos datasets
-df_modelo_completo = pd.concat([df_final_con_etiqueta, df_no_accidentes], ignore_index=True)
-
-# Guardamos el dataset combinado para el modelo
-print("\nGuardando dataset para modelo de predicción...")
-df_modelo_completo.to_excel(os.path.join(ruta_resultados, 'dataset_modelo_prediccion.xlsx'), index=False)
-print(f"Dataset para modelo guardado en: {os.path.join(ruta_resultados, 'dataset_modelo_prediccion.xlsx')}")
-
-# Estadísticas finales del dataset
-num_accidentes = df_modelo_completo['es_accidente'].sum()
-num_no_accidentes = len(df_modelo_completo) - num_accidentes
-print(f"\nEstadísticas del dataset para el modelo:")
-print(f"  - Total de registros: {len(df_modelo_completo)}")
-print(f"  - Accidentes: {num_accidentes} ({num_accidentes/len(df_modelo_completo)*100:.1f}%)")
-print(f"  - No accidentes: {num_no_accidentes} ({num_no_accidentes/len(df_modelo_completo)*100:.1f}%)")
+        yield bloque
+
+def generar_no_accidentes(df_accidentes, factor_multiplicador=5, semilla=None, tamano_bloque=200_000,
+                          celdas=None):
+    bloques = iterar_no_accidentes(df_accidentes, factor_multiplicador, semilla, tamano_bloque, celdas)
+    return pd.concat(bloques, ignore_index=True)
+
+# Función para pasar un bloque de no accidentes al esquema del dataset del modelo
+# (el de los accidentes): las columnas que el bloque no tiene quedan como nulos
+def tabla_con_esquema(bloque, esquema):
+    tabla = pa.Table.from_pandas(bloque, preserve_index=False)
+    columnas = [tabla.column(campo.name) if campo.name in tabla.column_names
+                else pa.nulls(len(tabla), campo.type) for campo in esquema]
+    return pa.table(columnas, names=esquema.names).cast(esquema)
+
+# El dataset para el modelo necesita el histórico completo (no se genera con un lote)
+if modo_incremental:
+    print("\nModo incremental: no se genera el dataset para el modelo.")
+else:
+    # Después de guardar el dataset final de accidentes
+    print("\nPreparando dataset para modelo de predicción...")
+
+    # Añadimos la etiqueta de accidente a los datos originales
+    df_final_con_etiqueta = df_final_limpio.copy()
+    df_final_con_etiqueta['es_accidente'] = 1
+
+    # Generamos datos de no accidentes (3 por accidente)
+    # Los no accidentes se colocan solo en celdas (distrito, fecha, franja_horaria) sin ningún
+    # accidente real. La semilla fija hace que el dataset generado sea reproducible
+    factor_no_accidentes = 3
+    celdas_vacias = muestrear_celdas_vacias(df_final_con_etiqueta, len(df_final_con_etiqueta) * factor_no_accidentes,
+                                            semilla=42)
+    df_final_con_etiqueta = aplicar_tipos(df_final_con_etiqueta, etapa='03 dataset modelo')
+
+    # Guardamos el dataset para el modelo por bloques: primero los accidentes y después
+    # cada bloque de no accidentes, sin unirlos en un solo DataFrame (la memoria no crece
+    # con el factor de no accidentes). Los bloques se convierten al esquema de los
+    # accidentes.
+    print("\nGuardando dataset para modelo de predicción...")
+    ruta_dataset_modelo = os.path.join(ruta_resultados, 'dataset_modelo_prediccion.parquet')
+    temporal = ruta_dataset_modelo + '.tmp'
+    tabla = pa.Table.from_pandas(df_final_con_etiqueta, preserve_index=False)
+    num_accidentes = len(df_final_con_etiqueta)
+    num_no_accidentes = 0
+    with pq.ParquetWriter(temporal, tabla.schema) as escritor:
+        escritor.write_table(tabla)
+        for df_no_accidentes in iterar_no_accidentes(df_final_con_etiqueta, semilla=42, celdas=celdas_vacias):
+            df_no_accidentes['es_accidente'] = 0  # Variable para no accidentes
+            escritor.write_table(tabla_con_esquema(df_no_accidentes, tabla.schema))
+            num_no_accidentes += len(df_no_accidentes)
+    os.replace(temporal, ruta_dataset_modelo)
+    print(f"Dataset para modelo guardado en: {ruta_dataset_modelo}")
+
+    # Estadísticas finales del dataset
+    total_registros = num_accidentes + num_no_accidentes
+    print(f"\nEstadísticas del dataset para el modelo:")
+    print(f"  - Total de registros: {total_registros}")
+    print(f"  - Accidentes: {num_accidentes} ({num_accidentes/total_registros*100:.1f}%)")
+    print(f"  - No accidentes: {num_no_accidentes} ({num_no_accidentes/total_registros*100:.1f}%)")
 
 print("\n=== Procesamiento completado con éxito ===")
 
@@ -7,20 +7,23 @@ Original file is located at
     https://colab.research.google.com/drive/1b7RO88YdVpaGdYv8pG8kSVzJidgsL9Ja
 """
 
-#Cargamos los datos
+#Cargamos los datos (pipeline.py pasa la ruta en TFM_RUTA_DATOS_MODELO)
+import os
 import pandas as pd
-data = pd.read_excel("df_final_con_gravedad.xlsx")
+from lectura_datos import aplicar_tipos
+data = pd.read_parquet(os.environ.get('TFM_RUTA_DATOS_MODELO', "df_2020_final_con_gravedad.parquet"))
+# El Parquet ya guarda los tipos de la etapa 03 (categóricas y enteros pequeños)
+data = aplicar_tipos(data, etapa='04 carga')
 
 data.head()
 
 import pandas as pd
 
-# Nos aseguramos que dia_hora está en formato datetime
-data['dia_hora'] = pd.to_datetime(data['dia_hora'])
+# dia_hora ya viene como fecha desde el Parquet, no hace falta convertirla
 
 # Separar en dos columnas para luego hacer la clasificacion de franja horaria
-data['fecha'] = data['dia_hora'].dt.date
-data['hora'] = data['dia_hora'].dt.time
+data['fecha'] = data['dia_hora'].dt.normalize()
+data['hora'] = data['dia_hora'].dt.hour
 
 #Eliminamos columnas que no aporten informacion al modelo
 #Eliminamos las features que no podamos saber antes del que se produzca un supuesto accidente
@@ -47,15 +50,26 @@ data['Nevando']=(data["estado_meteorológico"]=='Nevando').astype(int)
 
 data=data.drop(columns=["estado_meteorológico"])
 
+# Cómo se resume cada tipo de vehículo en la celda: 'any' = 1 si aparece en algún
+# accidente, 'sum' = suma de la columna (número de vehículos de ese tipo)
+agregacion_vehiculos = {
+    'vehiculo_dos_ruedas': ('Vehículo de dos ruedas', 'any'),
+    'vehiculo_pesado': ('Vehículo pesado', 'any'),
+    'turismo': ('Turismo', 'any'),
+    'otros_vehiculos': ('Otros vehículos', 'any'),
+}
+
+# Para 'any' se marca cada fila con 0/1 y se agrega con max; así todas las
+# agregaciones son reducciones nativas de pandas, sin funciones Python por grupo
+for destino, (origen, modo) in agregacion_vehiculos.items():
+    data[destino] = (data[origen] != 0).astype('uint8') if modo == 'any' else data[origen]
+
 # Agrupar por 'distrito', 'fecha' y 'franja_horaria'
 # Luego, podemos aplicar funciones de agregación.
-agrupacion_completa = data.groupby(['distrito', 'fecha', 'franja_horaria']).agg(
+agrupacion_completa = data.groupby(['distrito', 'fecha', 'franja_horaria'], observed=True).agg(
     #total_conductores=('Conductores', 'sum'), lo quitamos por que nunca sabremos de antemano el numero de conductores de un accidente
     total_pasajeros=('Pasajeros', 'median'), #Ponemos mediana para estimar el numero de pasajeros más frecuente.
-    vehiculo_dos_ruedas=('Vehículo de dos ruedas', lambda x: int((x != 0).any())), #Si al final se usa la suma, cambia lambda por sum
-    vehiculo_pesado=('Vehículo pesado', lambda x: int((x != 0).any())),
-    turismo=('Turismo', lambda x: int((x != 0).any())),
-    otros_vehiculos=('Otros vehículos', lambda x: int((x != 0).any())),
+    **{destino: (destino, 'max' if modo == 'any' else 'sum') for destino, (_, modo) in agregacion_vehiculos.items()},
     tiene_vulnerables=('tiene_vulnerables', 'sum'),
     indice_gravedad=('indice_gravedad', 'mean'),#Voy aprobar con la media
     Despejado=('Despejado', 'sum'),
@@ -69,6 +83,16 @@ agrupacion_completa = data.groupby(['distrito', 'fecha', 'franja_horaria']).agg(
 
 agrupacion_completa.head()
 
+# Comprobación (TFM_COMPROBAR_AGREGACION=1): las marcas 'any' coinciden con el cálculo
+# anterior, que usaba una lambda por grupo
+if os.environ.get('TFM_COMPROBAR_AGREGACION', '0') == '1':
+    columnas_any = {destino: origen for destino, (origen, modo) in agregacion_vehiculos.items() if modo == 'any'}
+    referencia = data.groupby(['distrito', 'fecha', 'franja_horaria'], observed=True).agg(
+        **{destino: (origen, lambda x: int((x != 0).any())) for destino, origen in columnas_any.items()}
+    ).reset_index()
+    pd.testing.assert_frame_equal(agrupacion_completa[referencia.columns], referencia, check_dtype=False)
+    print(f"Comprobación de la agregación correcta: {list(columnas_any)}")
+
 #Vamos a comprar el numero de filas esperado (nº distritos por las 4 franjas horarias y por todos los dias de año)
 # Lo renombramos como df para simplificar
 df = agrupacion_completa
@@ -85,15 +109,13 @@ print(f"Registros actuales: {len(df)}")
 
 """Se ve que faltan datos, seguramente de deba a un error en la generacion de las filas de no accidente"""
 
-import itertools
-#combinaciones['fecha'] = pd.to_datetime(combinaciones['fecha'])
-df['fecha'] = pd.to_datetime(df['fecha'])
-# Producto cartesiano de todas las combinaciones posibles
-combinaciones = pd.DataFrame(itertools.product(distritos, fechas, franjas),
-                             columns=['distrito', 'fecha', 'franja_horaria'])
-df_completo = pd.merge(combinaciones, df,
-                       on=['distrito', 'fecha', 'franja_horaria'],
-                       how='left')
+# Producto cartesiano de todas las combinaciones posibles.
+# MultiIndex.from_product guarda cada eje una sola vez y las combinaciones como
+# códigos enteros (sin crear tuplas); reindex coloca cada fila agregada en su celda
+# y deja vacías las que no tienen datos, en el mismo orden que el producto.
+claves = ['distrito', 'fecha', 'franja_horaria']
+rejilla = pd.MultiIndex.from_product([distritos, fechas, franjas], names=claves)
+df_completo = df.set_index(claves).reindex(rejilla).reset_index()
 columnas_a_rellenar = [
     #'total_conductores',
     'total_pasajeros',
@@ -122,34 +144,19 @@ df_completo.loc[df_completo['indice_gravedad'] == 0, columnas_a_ajustar] = 0
 df_completo.head()
 print(f"Registros actuales: {len(df_completo)}")
 
-# Si no tienes el locale configurado en español, puedes traducir manualmente:
-dias_esp = {
-    'Monday': 'Lunes',
-    'Tuesday': 'Martes',
-    'Wednesday': 'Miércoles',
-    'Thursday': 'Jueves',
-    'Friday': 'Viernes',
-    'Saturday': 'Sábado',
-    'Sunday': 'Domingo'
-}
-df_completo['dia_semana'] = df_completo['fecha'].dt.day_name().map(dias_esp)
-
+# Día de la semana (en español), mes, día y festivo salen de la tabla calendario,
+# calculada una vez para el rango de fechas y unida por clave entera (la fecha a medianoche)
 #La fecha la separamos en mes y dia, esto ya que el modelo no aprende de formato datetime
 #Respecto al año, lo más lógico es eliminarlo, ya que el modelo va a predecir con un año distinto al de aprendizaje
-# Asegúrate de que la columna 'fecha' es tipo datetime
-df_completo["fecha"] = pd.to_datetime(df_completo["fecha"])
-
-# Extrae año, mes y día
-df_completo["mes"] = df_completo["fecha"].dt.month
-df_completo["día"] = df_completo["fecha"].dt.day
-
+#El festivo nos dice si es un día festivo o no (festivos de Madrid, con la librería holidays)
+# !pip install holidays
+from calendario import tabla_calendario, unir_calendario
 
-#Ahora vamos a crear una columna llamada festivo, que nos dice si es un día festivo o no
-!pip install holidays
-import holidays
-
-festivos = holidays.country_holidays('ES', subdiv='MD')
-df_completo['es_festivo'] = df_completo['fecha'].dt.date.apply(lambda x: 1 if x in festivos else 0)
+calendario = tabla_calendario(fechas[0], fechas[-1])
+df_completo = unir_calendario(df_completo, calendario,
+                              {'dia_semana': 'dia_semana', 'mes': 'mes', 'dia': 'día', 'es_festivo': 'es_festivo'},
+                              columna_fecha='fecha')
+df_completo = aplicar_tipos(df_completo, etapa='04 rejilla completa')
 
 #ELiminamos fecha
 df_completo=df_completo.drop(columns=["fecha"])
@@ -158,18 +165,20 @@ df_completo.info()
 
 from sklearn.model_selection import train_test_split
 
-# Detectar columnas categóricas automáticamente (dtype == object)
-categorical_cols = df_completo.select_dtypes(include=['object']).columns.tolist()
+# Detectar columnas categóricas automáticamente (texto o categóricas)
+categorical_cols = df_completo.select_dtypes(include=['object', 'string', 'category']).columns.tolist()
 
 # Si quieres eliminar la variable objetivo 'categoria_gravedad' de la codificación
 if 'indice_gravedad' in categorical_cols:
     categorical_cols.remove('indice_gravedad')
 
-# Aplicar One-Hot Encoding con pandas
-data_encoded = pd.get_dummies(df_completo, columns=categorical_cols, drop_first=True)
+# En lugar de One-Hot Encoding (una columna densa 0/1 por valor), las columnas
+# categóricas se pasan a XGBoost como categóricas de pandas (enable_categorical)
+for col in categorical_cols:
+    df_completo[col] = df_completo[col].astype('category')
 
-X_data = data_encoded.drop("indice_gravedad", axis=1)
-y_data = data_encoded["indice_gravedad"]
+X_data = df_completo.drop("indice_gravedad", axis=1)
+y_data = df_completo["indice_gravedad"]
 
 from sklearn.model_selection import train_test_split
 X_train, X_val, y_train, y_val = train_test_split(X_data, y_data, test_size=0.2, random_state=42, shuffle= True)
@@ -180,16 +189,17 @@ from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.metrics import mean_squared_error, mean_absolute_error
 
-!pip install xgboost
+# !pip install xgboost
 import xgboost as xgb
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 
 # Convertir datos a DMatrix
-dtrain = xgb.DMatrix(X_train, label=y_train)
-dval = xgb.DMatrix(X_val, label=y_val)
+dtrain = xgb.DMatrix(X_train, label=y_train, enable_categorical=True)
+dval = xgb.DMatrix(X_val, label=y_val, enable_categorical=True)
 
 params = {
     'objective': 'reg:squarederror',
+    'tree_method': 'hist',  # necesario para las variables categóricas
     'max_depth': 6,
     'subsample': 0.8,
     'seed': 42
@@ -220,6 +230,13 @@ print(f"Train MSE: {mse_train:.4f}, MAE: {mae_train:.4f}")
 print(f"Val MSE: {mse_val:.4f}, MAE: {mae_val:.4f}")
 print(f"Train R2: {r2_train:.4f}, Val R2: {r2_val:.4f}")
 
+# Exportamos el modelo (booster binario + columnas, tipos y categorías) para que la
+# predicción no necesite reentrenar ni cargar los datos (ver predictor.py)
+from predictor import CachePredicciones, Predictor, exportar_modelo
+ruta_modelo = os.environ.get('TFM_RUTA_MODELO', 'modelo_gravedad')
+version_modelo = exportar_modelo(model_xb, X_train, ruta_modelo)
+print(f"Modelo guardado en {ruta_modelo} (versión {version_modelo})")
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -371,47 +388,35 @@ def mostrar_mapa(df_pred):
     ax.axis("off")
     plt.show()
 
-feature_names = X_train.columns.tolist()  # variable global o en scope accesible
+# El widget predice con el modelo exportado, igual que lo haría un proceso aparte.
+# El codificador se prepara una vez y cada clic solo rellena un escenario; los
+# escenarios repetidos salen de la caché sin volver a predecir.
+predictor = Predictor(ruta_modelo)
+codificador = predictor.codificador(distritos)
+cache_predicciones = CachePredicciones(codificador)
 
 def on_button_clicked(b):
-    rows = []
-    for distrito in distritos:
-        row = {
-            'distrito': distrito,
-            'total_pasajeros': pasajeros.value,
-            'mes': mes.value,
-            'dia': dia.value,
-            'es_festivo': es_festivo.value,
-            'dia_semana': dia_semana.value,
-            'tiene_vulnerables': tiene_vulnerables.value,
-            'franja_horaria': franja_horaria.value,
-            'vehiculo_dos_ruedas': vehiculo_dos_ruedas.value,
-            'vehiculo_pesado': vehiculo_pesado.value,
-            'turismo': turismo.value,
-            'otros_vehiculos': otros_vehiculos.value,
-        }
-        for clima in clima_widgets:
-            row[clima] = int(clima_widgets[clima].value)
-        rows.append(row)
-
-    df_input = pd.DataFrame(rows)
-
-    # One-hot encoding
-    df_encoded = pd.get_dummies(df_input)
-
-    # Añadir columnas faltantes con ceros
-    for col in feature_names:
-        if col not in df_encoded.columns:
-            df_encoded[col] = 0
-
-    # Reordenar columnas para coincidir con el entrenamiento
-    df_encoded = df_encoded[feature_names]
-
-    # Crear DMatrix para la predicción
-    dmatrix_input = xgb.DMatrix(df_encoded, feature_names=feature_names)
-
-    # Predecir con Booster
-    df_input["predicción_Índice_Gravedad"] = model_xb.predict(dmatrix_input)
+    escenario = {
+        'total_pasajeros': pasajeros.value,
+        'mes': mes.value,
+        'día': dia.value,
+        'es_festivo': es_festivo.value,
+        'dia_semana': dia_semana.value,
+        'tiene_vulnerables': tiene_vulnerables.value,
+        'franja_horaria': franja_horaria.value,
+        'vehiculo_dos_ruedas': vehiculo_dos_ruedas.value,
+        'vehiculo_pesado': vehiculo_pesado.value,
+        'turismo': turismo.value,
+        'otros_vehiculos': otros_vehiculos.value,
+    }
+    for clima in clima_widgets:
+        escenario[clima] = int(clima_widgets[clima].value)
+
+    # Una fila por distrito con un solo inplace_predict
+    df_input = pd.DataFrame({
+        'distrito': codificador.distritos,
+        "predicción_Índice_Gravedad": cache_predicciones.predecir([escenario])[0],
+    })
 
     # Mostrar resultados
     display(df_input[['distrito', "predicción_Índice_Gravedad"]].sort_values(by="predicción_Índice_Gravedad", ascending=False))
@@ -0,0 +1,102 @@
+# Agregados acumulados de accidentalidad guardados en SQLite.
+#
+# Para cada dimensión (distrito, tipo de accidente, franja horaria) y valor se
+# guarda el número de expedientes y la suma del índice de gravedad, de modo que
+# las medias se obtienen sin volver a leer el histórico. La tabla `expedientes`
+# guarda los expedientes ya contados: al añadir un lote solo se suman los nuevos y
+# el coste depende del tamaño del lote, no del histórico.
+#
+# Los expedientes de un lote que ya estén contados se ignoran (no se actualizan).
+import sqlite3
+
+import pandas as pd
+
+DIMENSIONES = ['distrito', 'tipo_accidente', 'franja_horaria']
+ORDEN_FRANJAS = ['Mañana', 'Tarde', 'Noche', 'Madrugada']
+
+
+def abrir_agregados(ruta):
+    conexion = sqlite3.connect(ruta)
+    with conexion:
+        conexion.execute("CREATE TABLE IF NOT EXISTS expedientes (num_expediente TEXT PRIMARY KEY)")
+        conexion.execute("""
+            CREATE TABLE IF NOT EXISTS agregados (
+                dimension TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                accidentes INTEGER NOT NULL,
+                suma_gravedad REAL NOT NULL,
+                n_gravedad INTEGER NOT NULL,
+                PRIMARY KEY (dimension, valor)
+            )""")
+    return conexion
+
+
+# Borra todos los agregados (para reconstruirlos desde el histórico completo)
+def vaciar_agregados(conexion):
+    with conexion:
+        conexion.execute("DELETE FROM expedientes")
+        conexion.execute("DELETE FROM agregados")
+
+
+# Suma un lote de expedientes (una fila por expediente con las columnas de
+# DIMENSIONES e 'indice_gravedad') a los agregados. Devuelve cuántos eran nuevos.
+def actualizar_agregados(conexion, df_expedientes, dimensiones=DIMENSIONES):
+    lote = df_expedientes.drop_duplicates(subset=['num_expediente'])
+    lote = lote[lote['num_expediente'].notna()]
+    ids = lote['num_expediente'].astype(str).tolist()
+
+    with conexion:
+        # Los ya contados se buscan por clave primaria, solo para los ids del lote
+        conexion.execute("CREATE TEMP TABLE IF NOT EXISTS lote (num_expediente TEXT PRIMARY KEY)")
+        conexion.execute("DELETE FROM lote")
+        conexion.executemany("INSERT OR IGNORE INTO lote VALUES (?)", ((i,) for i in ids))
+        vistos = {fila[0] for fila in conexion.execute(
+            "SELECT num_expediente FROM lote JOIN expedientes USING (num_expediente)")}
+        nuevos = lote[[i not in vistos for i in ids]]
+        conexion.executemany("INSERT INTO expedientes VALUES (?)",
+                             ((i,) for i in nuevos['num_expediente'].astype(str)))
+
+        for dimension in dimensiones:
+            if dimension not in nuevos.columns:
+                continue
+            grupos = nuevos.groupby(dimension, observed=True)['indice_gravedad'].agg(['size', 'sum', 'count'])
+            conexion.executemany("""
+                INSERT INTO agregados VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (dimension, valor) DO UPDATE SET
+                    accidentes = accidentes + excluded.accidentes,
+                    suma_gravedad = suma_gravedad + excluded.suma_gravedad,
+                    n_gravedad = n_gravedad + excluded.n_gravedad""",
+                ((dimension, str(valor), int(fila['size']), float(fila['sum']), int(fila['count']))
+                 for valor, fila in grupos.iterrows()))
+    return len(nuevos)
+
+
+def leer_dimension(conexion, dimension):
+    return pd.read_sql_query(
+        "SELECT valor, accidentes, suma_gravedad, n_gravedad FROM agregados WHERE dimension = ? ORDER BY valor",
+        conexion, params=(dimension,), index_col='valor')
+
+
+# Tablas acumuladas con la misma forma que las que calcula la etapa 03
+def tablas_agregadas(conexion):
+    distrito = leer_dimension(conexion, 'distrito')
+    tipo = leer_dimension(conexion, 'tipo_accidente')
+    franja = leer_dimension(conexion, 'franja_horaria')
+
+    accidentes_por_distrito = distrito['accidentes'].rename_axis('distrito').reset_index()
+    accidentes_por_distrito.columns = ['distrito', 'num_accidentes']
+    accidentes_por_distrito = accidentes_por_distrito.sort_values('num_accidentes', ascending=False)
+
+    accidentes_por_tipo = tipo['accidentes'].rename_axis('tipo_accidente').rename('num_expediente')
+    accidentes_por_tipo = accidentes_por_tipo.sort_values(ascending=False)
+
+    def medias(tabla, nombre):
+        return (tabla['suma_gravedad'] / tabla['n_gravedad']).rename_axis(nombre).rename('indice_gravedad')
+
+    return {
+        'accidentes_por_distrito': accidentes_por_distrito,
+        'accidentes_por_tipo': accidentes_por_tipo,
+        'gravedad_por_distrito': medias(distrito, 'distrito').sort_values(ascending=False),
+        'gravedad_por_tipo': medias(tipo, 'tipo_accidente').sort_values(ascending=False),
+        'gravedad_por_franja': medias(franja, 'franja_horaria').reindex(ORDEN_FRANJAS),
+    }
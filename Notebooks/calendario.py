@@ -0,0 +1,81 @@
+# Tabla calendario: una fila por hora con las variables de fecha que usan las etapas.
+#
+# En lugar de derivar día de la semana, franja horaria o festivo fila a fila (con
+# apply o con to_datetime repetidos), se calcula una vez la tabla del rango de
+# fechas y cada etapa la une por una clave entera: las horas desde 1970-01-01.
+# Las variables que solo dependen del día (día de la semana, mes, día, festivo) se
+# pueden unir también a una columna de fechas a medianoche.
+import numpy as np
+import pandas as pd
+
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+FRANJAS = ['Madrugada', 'Mañana', 'Tarde', 'Noche']
+
+# Horas de cada franja horaria (lo que no sea mañana, tarde o noche es madrugada, de 22 a 6)
+HORAS_POR_FRANJA = {
+    'Mañana': (6, 12),
+    'Tarde': (12, 18),
+    'Noche': (18, 22),
+}
+
+
+# Franja horaria de cada hora
+def franja_de_hora(horas):
+    horas = np.asarray(horas)
+    franjas = np.full(horas.shape, 'Madrugada', dtype=object)
+    for nombre, (desde, hasta) in HORAS_POR_FRANJA.items():
+        franjas[(desde <= horas) & (horas < hasta)] = nombre
+    return franjas
+
+
+# Clave entera de cada fecha/hora: horas transcurridas desde 1970-01-01 00:00
+def clave_horaria(fechas):
+    return np.asarray(fechas, dtype='datetime64[ns]').astype('datetime64[h]').astype(np.int64)
+
+
+# Festivos de Madrid (nacionales y de la Comunidad) de cada día del rango.
+# La librería holidays solo hace falta si se piden los festivos.
+def _festivos(dias):
+    import holidays
+    festivos = holidays.country_holidays('ES', subdiv='MD', years=range(dias.year.min(), dias.year.max() + 1))
+    return dias.isin(pd.DatetimeIndex(list(festivos.keys()))).astype(np.uint8)
+
+
+# Tabla con una fila por hora entre `inicio` y `fin` (días completos), indexada por
+# la clave entera
+def tabla_calendario(inicio, fin, festivos=True):
+    dias = pd.date_range(pd.Timestamp(inicio).normalize(), pd.Timestamp(fin).normalize(), freq='D')
+    horas = pd.date_range(dias[0], dias[-1] + pd.Timedelta(hours=23), freq='h')
+    hora = horas.hour.to_numpy().astype(np.uint8)
+
+    tabla = pd.DataFrame({
+        'fecha': horas.normalize(),
+        'hora': hora,
+        'dia_semana': pd.Categorical.from_codes(horas.dayofweek, categories=DIAS_SEMANA, ordered=True),
+        'mes': horas.month.to_numpy().astype(np.uint8),
+        'dia': horas.day.to_numpy().astype(np.uint8),
+        'franja_horaria': pd.Categorical(franja_de_hora(np.arange(24))[hora], categories=FRANJAS),
+    }, index=pd.Index(clave_horaria(horas), name='clave'))
+    if festivos:
+        # Se calcula por día y se repite en sus 24 horas
+        tabla['es_festivo'] = np.repeat(_festivos(dias), 24)
+    return tabla
+
+
+# Añade al DataFrame (en el sitio) las columnas de la tabla calendario que
+# correspondan a cada fila de `columna_fecha`. `columnas` puede ser una lista o un
+# diccionario {columna_calendario: columna_destino}.
+def unir_calendario(df, tabla, columnas, columna_fecha='dia_hora'):
+    if not isinstance(columnas, dict):
+        columnas = {columna: columna for columna in columnas}
+    # La tabla es continua (una fila por hora), así que la posición sale de restar claves
+    posiciones = clave_horaria(df[columna_fecha]) - tabla.index[0]
+    if len(posiciones) and (posiciones.min() < 0 or posiciones.max() >= len(tabla)):
+        raise ValueError("Hay fechas fuera del rango de la tabla calendario")
+    for origen, destino in columnas.items():
+        valores = tabla[origen]
+        if isinstance(valores.dtype, pd.CategoricalDtype):
+            df[destino] = valores.array.take(posiciones)
+        else:
+            df[destino] = valores.to_numpy()[posiciones]
+    return df
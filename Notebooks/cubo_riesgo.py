@@ -0,0 +1,262 @@
+# Cubo de riesgo: predicciones precalculadas para todo el espacio de escenarios.
+#
+# Las entradas del modelo son pocas y discretas (franja, mes, día, día de la
+# semana, festivo, clima, vehículos...), así que se pueden predecir todas de una
+# vez y guardar en un array con un eje por variable y un último eje de distritos.
+# Consultar un escenario es entonces buscar su índice en cada eje, sin llamar al
+# modelo. Los escenarios se reparten por bloques entre varios procesos; cada uno
+# codifica su bloque con numpy, lo predice con inplace_predict y lo escribe
+# directamente en el fichero (memmap), sin pasar los resultados por el proceso
+# principal.
+#
+#     cubo_riesgo/<version>/cubo.npy    float32, forma (eje_1, ..., eje_n, distritos)
+#     cubo_riesgo/<version>/ejes.json   ejes con sus opciones, valores fijos y distritos
+#
+# Se incluyen todas las combinaciones de los ejes, también las que no existen en el
+# calendario (31 de febrero o un día de la semana que no corresponde a la fecha),
+# para que el índice de cada escenario se calcule directamente.
+#
+#     python cubo_riesgo.py                                  # ejes por defecto
+#     python cubo_riesgo.py --ejes franja_horaria mes clima vehiculos --procesos 4 \
+#         --fijos '{"día": 15, "dia_semana": "Miércoles"}'
+#
+# Cada variable del modelo (salvo el distrito) tiene que ser un eje o tener un valor
+# fijo: si no, el cubo se construiría con la variable como nula.
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from predictor import RUTA_MODELO, Predictor
+
+RUTA_CUBO = 'cubo_riesgo'
+FICHERO_CUBO = 'cubo.npy'
+FICHERO_EJES = 'ejes.json'
+TAMANO_BLOQUE = 20_000
+
+CLIMAS = ['Despejado', 'Lluvia_débil', 'Lluvia_intensa', 'Nublado', 'Granizo', 'Nevando']
+VEHICULOS = ['vehiculo_dos_ruedas', 'vehiculo_pesado', 'turismo', 'otros_vehiculos']
+
+# Valores de las variables que no son ejes del cubo (los mismos que el widget por defecto)
+VALORES_FIJOS = {
+    'total_pasajeros': 0,
+    'tiene_vulnerables': 0,
+    'es_festivo': 0,
+    **{clima: 0 for clima in CLIMAS},
+    **{vehiculo: 0 for vehiculo in VEHICULOS},
+}
+
+
+def _eje_simple(nombre, valores):
+    return [(str(valor), {nombre: valor}) for valor in valores]
+
+
+# Ejes disponibles: cada opción es una etiqueta y los valores que fija en el escenario
+EJES = {
+    'franja_horaria': _eje_simple('franja_horaria', ['Madrugada', 'Mañana', 'Tarde', 'Noche']),
+    'mes': _eje_simple('mes', range(1, 13)),
+    'día': _eje_simple('día', range(1, 32)),
+    'dia_semana': _eje_simple('dia_semana', ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes',
+                                             'Sábado', 'Domingo']),
+    'es_festivo': _eje_simple('es_festivo', [0, 1]),
+    'tiene_vulnerables': _eje_simple('tiene_vulnerables', [0, 1]),
+    # Sin clima o un solo clima marcado
+    'clima': [('Ninguno', {clima: 0 for clima in CLIMAS})] + [
+        (clima, {otro: int(otro == clima) for otro in CLIMAS}) for clima in CLIMAS],
+    # Todas las combinaciones de los cuatro tipos de vehículo
+    'vehiculos': [
+        ('+'.join(v for v, marca in zip(VEHICULOS, marcas) if marca) or 'Ninguno', dict(zip(VEHICULOS, marcas)))
+        for marcas in itertools.product([0, 1], repeat=len(VEHICULOS))],
+}
+EJES_POR_DEFECTO = ['franja_horaria', 'mes', 'día', 'dia_semana', 'es_festivo', 'clima']
+
+
+# Valor comparable de una variable: los números (y True/False) como float y el resto como texto
+def _normalizar(valor):
+    if isinstance(valor, (bool, int, float, np.number)):
+        return float(valor)
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return str(valor)
+
+
+# Tablas para codificar con numpy: para cada eje, las posiciones de las columnas que
+# fija y una matriz (opciones x columnas) con sus valores ya codificados
+def _tablas_codificacion(predictor, ejes, fijos):
+    posiciones = {nombre: j for j, nombre in enumerate(predictor.columnas)}
+    base = np.full(len(predictor.columnas), np.nan, dtype=np.float32)
+    for nombre, valor in fijos.items():
+        if nombre in posiciones:
+            base[posiciones[nombre]] = predictor.valor(nombre, valor)
+    tablas = []
+    for eje in ejes:
+        campos = sorted({campo for _, valores in eje['opciones'] for campo in valores if campo in posiciones})
+        valores = np.array([[predictor.valor(campo, opcion.get(campo, fijos.get(campo))) for campo in campos]
+                            for _, opcion in eje['opciones']], dtype=np.float32)
+        tablas.append(([posiciones[campo] for campo in campos], valores))
+    return base, tablas
+
+
+_trabajo = {}
+
+
+def _iniciar_trabajador(carpeta_modelo, version, ruta_cubo, definicion):
+    predictor = Predictor(carpeta_modelo, version)
+    # Un hilo por proceso: el paralelismo viene de los procesos
+    predictor.booster.set_param({'nthread': 1})
+    base, tablas = _tablas_codificacion(predictor, definicion['ejes'], definicion['fijos'])
+    _trabajo.update(
+        predictor=predictor,
+        base=base,
+        tablas=tablas,
+        forma=tuple(len(eje['opciones']) for eje in definicion['ejes']),
+        posicion_distrito=predictor.columnas.index('distrito'),
+        codigos_distrito=np.array([predictor.valor('distrito', distrito) for distrito in definicion['distritos']],
+                                  dtype=np.float32),
+        cubo=np.load(ruta_cubo, mmap_mode='r+'),
+    )
+
+
+# Predice los escenarios [inicio, fin) (índice plano sobre los ejes) y los escribe en el cubo
+def _calcular_bloque(inicio, fin):
+    t = _trabajo
+    n, distritos = fin - inicio, len(t['codigos_distrito'])
+    indices = np.unravel_index(np.arange(inicio, fin), t['forma'])
+    escenarios = np.repeat(t['base'][None, :], n, axis=0)
+    for (columnas, valores), indice in zip(t['tablas'], indices):
+        escenarios[:, columnas] = valores[indice]
+    # Una fila por escenario y distrito, en el mismo orden que el último eje del cubo
+    matriz = np.repeat(escenarios, distritos, axis=0)
+    matriz[:, t['posicion_distrito']] = np.tile(t['codigos_distrito'], n)
+    prediccion = t['predictor'].booster.inplace_predict(matriz)
+    plano = t['cubo'].reshape(-1, distritos)
+    plano[inicio:fin] = prediccion.reshape(n, distritos)
+    plano.flush()
+    return n
+
+
+def construir_cubo(carpeta_modelo=RUTA_MODELO, carpeta_cubo=RUTA_CUBO, ejes=EJES_POR_DEFECTO, fijos=None,
+                   version=None, procesos=None, tamano_bloque=TAMANO_BLOQUE):
+    inicio_total = time.perf_counter()
+    predictor = Predictor(carpeta_modelo, version)
+    fijos = {**VALORES_FIJOS, **(fijos or {})}
+    distritos = list(predictor.codigos['distrito'])
+    cubiertas = set(fijos) | {campo for nombre in ejes for _, opcion in EJES[nombre] for campo in opcion}
+    faltan = [columna for columna in predictor.columnas if columna != 'distrito' and columna not in cubiertas]
+    if faltan:
+        raise ValueError(f"Las variables {faltan} no son ejes del cubo ni tienen valor fijo (use --ejes o --fijos)")
+    definicion = {
+        'version': predictor.version,
+        'ejes': [{'nombre': nombre, 'opciones': EJES[nombre]} for nombre in ejes],
+        'fijos': {nombre: valor for nombre, valor in fijos.items()
+                  if not any(nombre in opcion for eje in ejes for _, opcion in EJES[eje])},
+        'distritos': distritos,
+    }
+    forma = tuple(len(EJES[nombre]) for nombre in ejes)
+    n_escenarios = int(np.prod(forma))
+
+    # Se construye en una carpeta temporal y se sustituye al final
+    destino = os.path.join(carpeta_cubo, predictor.version)
+    temporal = destino + '.tmp'
+    shutil.rmtree(temporal, ignore_errors=True)
+    os.makedirs(temporal)
+    ruta = os.path.join(temporal, FICHERO_CUBO)
+    np.lib.format.open_memmap(ruta, mode='w+', dtype=np.float32, shape=forma + (len(distritos),)).flush()
+
+    procesos = procesos or os.cpu_count()
+    bloques = [(i, min(i + tamano_bloque, n_escenarios)) for i in range(0, n_escenarios, tamano_bloque)]
+    # spawn: cada proceso carga su propio booster (xgboost y fork no se llevan bien)
+    with ProcessPoolExecutor(procesos, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_iniciar_trabajador,
+                             initargs=(carpeta_modelo, predictor.version, ruta, definicion)) as ejecutor:
+        calculados = sum(ejecutor.map(_calcular_bloque, *zip(*bloques)))
+    if calculados != n_escenarios:
+        raise RuntimeError(f"Se han calculado {calculados} de {n_escenarios} escenarios")
+
+    with open(os.path.join(temporal, FICHERO_EJES), 'w', encoding='utf-8') as fichero:
+        json.dump(definicion, fichero, ensure_ascii=False, indent=1)
+    shutil.rmtree(destino, ignore_errors=True)
+    os.replace(temporal, destino)
+
+    segundos = time.perf_counter() - inicio_total
+    tamano = os.path.getsize(os.path.join(destino, FICHERO_CUBO))
+    print(f"Cubo {' x '.join(map(str, forma))} x {len(distritos)} distritos "
+          f"({n_escenarios:,} escenarios, {n_escenarios * len(distritos):,} predicciones)")
+    print(f"Tamaño: {tamano / 2**20:.1f} MB en {destino}")
+    print(f"Tiempo: {segundos:.1f} s con {procesos} procesos "
+          f"({n_escenarios * len(distritos) / segundos:,.0f} predicciones/s)")
+    return destino
+
+
+# Consulta del cubo: el fichero se abre con memory map y cada escenario se resuelve
+# con una búsqueda en un diccionario por eje.
+class CuboRiesgo:
+    def __init__(self, carpeta_cubo=RUTA_CUBO, version=None):
+        if version is None:
+            # La versión más reciente que haya en la carpeta
+            versiones = [nombre for nombre in os.listdir(carpeta_cubo)
+                         if os.path.isfile(os.path.join(carpeta_cubo, nombre, FICHERO_EJES))]
+            version = max(versiones, key=lambda v: os.path.getmtime(os.path.join(carpeta_cubo, v)))
+        origen = os.path.join(carpeta_cubo, version)
+        with open(os.path.join(origen, FICHERO_EJES), encoding='utf-8') as fichero:
+            self.definicion = json.load(fichero)
+        self.version = self.definicion['version']
+        self.distritos = self.definicion['distritos']
+        self.valores = np.load(os.path.join(origen, FICHERO_CUBO), mmap_mode='r')
+        self.fijos = {nombre: _normalizar(valor) for nombre, valor in self.definicion['fijos'].items()}
+        # Para cada eje: campos que fija y posición de cada combinación de valores
+        self._ejes = []
+        for eje in self.definicion['ejes']:
+            campos = sorted({campo for _, opcion in eje['opciones'] for campo in opcion})
+            posiciones = {tuple(_normalizar(opcion[campo]) for campo in campos): i
+                          for i, (_, opcion) in enumerate(eje['opciones'])}
+            self._ejes.append((campos, posiciones))
+        self._variables = set(self.fijos) | {campo for campos, _ in self._ejes for campo in campos}
+
+    # Índice del escenario en cada eje, o None si queda fuera del cubo (una variable
+    # que el cubo no fija, un valor que no es opción de un eje o una variable fija con
+    # otro valor)
+    def indice(self, escenario):
+        if not self._variables.issuperset(escenario):
+            return None
+        for nombre, valor in self.fijos.items():
+            if nombre in escenario and _normalizar(escenario[nombre]) != valor:
+                return None
+        indice = []
+        for campos, posiciones in self._ejes:
+            clave = tuple(_normalizar(escenario.get(campo, self.fijos.get(campo, 0))) for campo in campos)
+            posicion = posiciones.get(clave)
+            if posicion is None:
+                return None
+            indice.append(posicion)
+        return tuple(indice)
+
+    # Predicciones de los distritos para un escenario (None si está fuera del cubo)
+    def consultar(self, escenario):
+        indice = self.indice(escenario)
+        return None if indice is None else self.valores[indice]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precalcula las predicciones de todos los escenarios")
+    parser.add_argument('--modelo', default=os.environ.get('TFM_RUTA_MODELO', RUTA_MODELO),
+                        help="carpeta con el modelo exportado por la etapa 04")
+    parser.add_argument('--version', default=None, help="versión del modelo (por defecto la última)")
+    parser.add_argument('--salida', default=os.environ.get('TFM_RUTA_CUBO', RUTA_CUBO),
+                        help="carpeta donde se guarda el cubo")
+    parser.add_argument('--ejes', nargs='+', choices=list(EJES), default=EJES_POR_DEFECTO,
+                        help="variables que forman los ejes del cubo")
+    parser.add_argument('--fijos', type=json.loads, default=None,
+                        help="JSON con los valores de las variables que no son ejes")
+    parser.add_argument('--procesos', type=int, default=None, help="procesos (por defecto uno por núcleo)")
+    parser.add_argument('--bloque', type=int, default=TAMANO_BLOQUE, help="escenarios por bloque")
+    argumentos = parser.parse_args()
+    construir_cubo(argumentos.modelo, argumentos.salida, argumentos.ejes, argumentos.fijos,
+                   argumentos.version, argumentos.procesos, argumentos.bloque)
@@ -0,0 +1,271 @@
+# Lectura de los ficheros de accidentalidad con un esquema de tipos explícito.
+#
+# Los CSV se leen por bloques (`iterar_accidentalidad`) para que la memoria no
+# dependa del tamaño ni del número de ficheros: las columnas de texto con pocos
+# valores distintos se leen como categóricas, el código de distrito como entero
+# pequeño y la fecha/hora como datetime nativo, sin concatenar cadenas.
+#
+# El dataset unido de todos los años se guarda como Parquet particionado por año
+# (carpetas `anio=AAAA`), de forma que añadir un año solo escribe su partición y
+# las etapas siguientes pueden leer solo los años, distritos y columnas que usen.
+# Además se guarda una copia en formato Arrow IPC sin comprimir, un fichero por año,
+# que se abre con memory map: varios procesos en la misma máquina comparten las
+# mismas páginas y añadir un año solo escribe su fichero.
+#
+# `aplicar_tipos` es la política de tipos que comparten todas las etapas: el texto
+# con pocos valores distintos se guarda como categórico y los conteos y marcas como
+# enteros pequeños. Se aplica al cargar y después de crear columnas nuevas.
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+
+TAMANO_BLOQUE = 100_000
+
+COLUMNAS_CATEGORICAS = ['distrito', 'tipo_accidente', 'tipo_vehiculo', 'tipo_persona',
+                        'estado_meteorológico', 'franja_horaria', 'dia_semana', 'grupo_distrito',
+                        'categoria_gravedad']
+
+# Conteos por expediente y marcas 0/1
+TIPOS_ENTEROS = {
+    'Conductores': 'uint8',
+    'Pasajeros': 'uint8',
+    'Peatones': 'uint8',
+    'Vehículo de dos ruedas': 'uint8',
+    'Vehículo pesado': 'uint8',
+    'Turismo': 'uint8',
+    'Otros vehículos': 'uint8',
+    'total_implicados': 'int16',
+    'tiene_vulnerables': 'uint8',
+    'diversidad_vehiculos': 'uint8',
+    'es_accidente': 'uint8',
+    'hora': 'uint8',
+}
+
+# Ficheros originales del Ayuntamiento: separados por ';' y con fecha y hora por separado
+ESQUEMA_ORIGINAL = {
+    'num_expediente': str,
+    'fecha': str,
+    'hora': str,
+    'cod_distrito': 'float32',
+    'distrito': 'category',
+    'tipo_accidente': 'category',
+    'estado_meteorológico': str,
+    'tipo_vehiculo': 'category',
+    'tipo_persona': 'category',
+}
+
+# Ficheros ya procesados ({año}_Accidentalidad_COMPLETO.csv) con la columna dia_hora
+ESQUEMA_COMPLETO = {
+    'num_expediente': str,
+    'dia_hora': str,
+    'cod_distrito': 'float32',
+    'distrito': 'category',
+    'tipo_accidente': 'category',
+    'estado_meteorológico': 'category',
+    'tipo_vehiculo': 'category',
+    'tipo_persona': 'category',
+}
+
+
+def memoria_mb(df):
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+# Aplica la política de tipos a las columnas que existan en el DataFrame (en el
+# sitio). Los enteros solo se reducen si no hay nulos y los valores caben en el
+# tipo; si no, la columna se deja como está. Con `etapa` se imprime la memoria
+# antes y después.
+def aplicar_tipos(df, etapa=None, columnas_categoricas=COLUMNAS_CATEGORICAS, tipos_enteros=TIPOS_ENTEROS):
+    antes = memoria_mb(df) if etapa else None
+    for columna in columnas_categoricas:
+        if columna in df.columns and not isinstance(df[columna].dtype, pd.CategoricalDtype):
+            df[columna] = df[columna].astype('category')
+    for columna, tipo in tipos_enteros.items():
+        if columna not in df.columns or df[columna].dtype == tipo:
+            continue
+        valores = df[columna]
+        if not pd.api.types.is_numeric_dtype(valores) or valores.isna().any():
+            continue
+        limites = np.iinfo(tipo)
+        if len(valores) and (valores.min() < limites.min or valores.max() > limites.max):
+            continue
+        df[columna] = valores.astype(tipo)
+    if etapa:
+        despues = memoria_mb(df)
+        print(f"Memoria [{etapa}]: {antes:.1f} MB -> {despues:.1f} MB "
+              f"({(1 - despues / antes) * 100 if antes else 0:.0f}% menos)")
+    return df
+
+
+def _tipar_bloque(bloque, original):
+    if original:
+        # El día se repite mucho: to_datetime con caché, y la hora se suma como timedelta
+        dia_hora = (pd.to_datetime(bloque['fecha'], format='%d/%m/%Y', cache=True)
+                    + pd.to_timedelta(bloque['hora']))
+        bloque = bloque.drop(columns=['fecha', 'hora'])
+        bloque.insert(1, 'dia_hora', dia_hora)
+    else:
+        bloque['dia_hora'] = pd.to_datetime(bloque['dia_hora'], format='%Y-%m-%d %H:%M:%S', cache=True)
+    # Se lee como float porque los ficheros lo guardan como '13.0'
+    bloque['cod_distrito'] = bloque['cod_distrito'].astype('Int8')
+    return bloque
+
+
+# Recorre un fichero de accidentalidad por bloques ya tipados.
+# `original=True` para los CSV originales (';', fecha y hora separadas).
+def iterar_accidentalidad(ruta, original=False, tamano_bloque=TAMANO_BLOQUE):
+    esquema = ESQUEMA_ORIGINAL if original else ESQUEMA_COMPLETO
+    lector = pd.read_csv(
+        ruta,
+        delimiter=';' if original else ',',
+        usecols=list(esquema),
+        dtype=esquema,
+        chunksize=tamano_bloque,
+    )
+    with lector:
+        for bloque in lector:
+            yield _tipar_bloque(bloque, original)
+
+
+# Une bloques tipados manteniendo las columnas categóricas (pd.concat las
+# convertiría a texto si las categorías de cada bloque no coinciden).
+def concatenar_bloques(bloques):
+    bloques = list(bloques)
+    if not bloques:
+        raise ValueError("No hay bloques que concatenar")
+    df = pd.concat(bloques, ignore_index=True)
+    for columna in bloques[0].columns:
+        if isinstance(bloques[0][columna].dtype, pd.CategoricalDtype):
+            df[columna] = union_categoricals([bloque[columna] for bloque in bloques])
+    return df
+
+
+# Lee uno o varios ficheros de accidentalidad completos en un solo DataFrame tipado
+def leer_accidentalidad(rutas, original=False, tamano_bloque=TAMANO_BLOQUE):
+    if isinstance(rutas, str):
+        rutas = [rutas]
+    return concatenar_bloques(
+        bloque
+        for ruta in rutas
+        for bloque in iterar_accidentalidad(ruta, original, tamano_bloque)
+    )
+
+
+def _ruta_particion(ruta_dataset, anio):
+    return os.path.join(ruta_dataset, f'anio={anio}')
+
+
+# Indica si la partición del año ya existe y es más reciente que su fichero de origen
+def particion_actualizada(ruta_dataset, anio, ruta_origen):
+    fichero = os.path.join(_ruta_particion(ruta_dataset, anio), 'part-0.parquet')
+    return os.path.exists(fichero) and os.path.getmtime(fichero) >= os.path.getmtime(ruta_origen)
+
+
+# Escribe (o reemplaza) la partición de un año a partir de bloques tipados.
+# Solo se toca la carpeta de ese año; el resto del dataset no se reescribe.
+def escribir_particion(bloques, ruta_dataset, anio):
+    carpeta = _ruta_particion(ruta_dataset, anio)
+    # El prefijo '_' hace que pyarrow ignore la carpeta temporal al leer el dataset
+    temporal = os.path.join(ruta_dataset, f'_anio={anio}.tmp')
+    shutil.rmtree(temporal, ignore_errors=True)
+    os.makedirs(temporal)
+
+    filas = 0
+    escritor = None
+    try:
+        for bloque in bloques:
+            if escritor is None:
+                tabla = pa.Table.from_pandas(bloque, preserve_index=False)
+                escritor = pq.ParquetWriter(os.path.join(temporal, 'part-0.parquet'), tabla.schema)
+            else:
+                tabla = pa.Table.from_pandas(bloque, schema=escritor.schema_arrow, preserve_index=False)
+            escritor.write_table(tabla)
+            filas += len(bloque)
+    finally:
+        if escritor is not None:
+            escritor.close()
+
+    shutil.rmtree(carpeta, ignore_errors=True)
+    os.replace(temporal, carpeta)
+    return filas
+
+
+def abrir_dataset_unido(ruta_dataset):
+    return ds.dataset(ruta_dataset, format='parquet', partitioning='hive')
+
+
+# Lee el dataset unido filtrando por año y distrito antes de cargar nada en memoria
+# (los filtros se resuelven con las particiones y las estadísticas del Parquet).
+def leer_dataset_unido(ruta_dataset, columnas=None, anios=None, distritos=None):
+    filtro = None
+    if anios is not None:
+        filtro = ds.field('anio').isin(list(anios))
+    if distritos is not None:
+        filtro_distrito = ds.field('distrito').isin(list(distritos))
+        filtro = filtro_distrito if filtro is None else filtro & filtro_distrito
+    tabla = abrir_dataset_unido(ruta_dataset).to_table(columns=columnas, filter=filtro)
+    return tabla.to_pandas()
+
+
+def _ruta_arrow_particion(carpeta_arrow, anio):
+    return os.path.join(carpeta_arrow, f'anio={anio}.arrow')
+
+
+# Indica si el fichero Arrow del año existe y es más reciente que su partición Parquet
+def arrow_actualizado(ruta_dataset, anio, carpeta_arrow):
+    fichero = _ruta_arrow_particion(carpeta_arrow, anio)
+    particion = os.path.join(_ruta_particion(ruta_dataset, anio), 'part-0.parquet')
+    return os.path.exists(fichero) and os.path.getmtime(fichero) >= os.path.getmtime(particion)
+
+
+# Vuelca la partición de un año a su fichero Arrow IPC (sin compresión) para poder
+# abrirlo con memory map. Solo se lee ese año, así que la memoria no depende del
+# histórico. Las categorías se unifican y las columnas se juntan en un solo bloque
+# (record batch): así cada columna es un único buffer contiguo en el fichero y al
+# abrirlo se puede usar sin copiar.
+def exportar_arrow(ruta_dataset, anio, carpeta_arrow):
+    # Las versiones anteriores guardaban un único fichero con todos los años
+    if os.path.isfile(carpeta_arrow):
+        os.remove(carpeta_arrow)
+    os.makedirs(carpeta_arrow, exist_ok=True)
+    tabla = abrir_dataset_unido(ruta_dataset).to_table(filter=ds.field('anio') == anio)
+    tabla = tabla.unify_dictionaries().combine_chunks()
+    ruta_arrow = _ruta_arrow_particion(carpeta_arrow, anio)
+    temporal = ruta_arrow + '.tmp'
+    with pa.OSFile(temporal, 'wb') as destino:
+        with pa.ipc.new_file(destino, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+    os.replace(temporal, ruta_arrow)
+    return tabla.num_rows
+
+
+def _tipo_arrow(tipo):
+    return None if pa.types.is_dictionary(tipo) else pd.ArrowDtype(tipo)
+
+
+# Abre los ficheros Arrow de cada año con memory map. Cada año es un bloque de la
+# tabla y las columnas del DataFrame se quedan con tipos de Arrow (pd.ArrowDtype),
+# que envuelven esos bloques sin copiarlos: la memoria de la carga son páginas del
+# fichero compartidas entre procesos. Las categóricas son la excepción: pasan a
+# categóricas de pandas, que copian sus códigos (un byte por fila) al unificar las
+# categorías de los años. Convertir una columna a tipos de numpy sí crea una copia
+# privada de esa columna.
+def abrir_arrow(ruta_arrow, columnas=None):
+    if os.path.isdir(ruta_arrow):
+        rutas = sorted(os.path.join(ruta_arrow, nombre) for nombre in os.listdir(ruta_arrow)
+                       if nombre.endswith('.arrow'))
+    else:
+        rutas = [ruta_arrow]
+    tablas = []
+    for ruta in rutas:
+        tabla = pa.ipc.open_file(pa.memory_map(ruta, 'r')).read_all()
+        tablas.append(tabla if columnas is None else tabla.select(columnas))
+    if not tablas:
+        raise FileNotFoundError(f"No hay ficheros Arrow en {ruta_arrow}")
+    return pa.concat_tables(tablas).to_pandas(types_mapper=_tipo_arrow)
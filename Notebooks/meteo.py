@@ -0,0 +1,128 @@
+# Datos meteorológicos horarios de meteostat con caché local en disco.
+#
+# Guardamos un Parquet por estación (punto lat/lon) y año dentro de `RUTA_CACHE`:
+#
+#     cache_meteo/40.4168_-3.7038/2021.parquet
+#
+# Cada fichero guarda las columnas originales de meteostat (prcp, temp, ...) y,
+# junto a ellas, la clasificación de la lluvia ya calculada, para no repetirla
+# en cada carga. Cuando se pide un rango solo se descargan las horas que no
+# estén ya en la caché, y en modo offline no se accede a la red en ningún caso.
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+RUTA_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_meteo')
+
+COLUMNA_CLASIFICACION = 'estado_meteorologico_clasificado'
+
+# Las horas sin dato en meteostat se guardan como filas vacías para no volver a
+# pedirlas, salvo las más recientes, que la estación aún puede publicar.
+MARGEN_DATOS_RECIENTES = timedelta(days=7)
+
+
+# Umbrales (mm/hora) que separan cada clase de lluvia: cada valor se asigna a la
+# clase cuyo intervalo [umbral_anterior, umbral) lo contiene. Los valores nulos o
+# por debajo del primer umbral son "Despejado".
+UMBRALES_LLUVIA = [0.1, 2, 10, 50]
+ETIQUETAS_LLUVIA = ["Despejado", "Lluvia débil", "Lluvia moderada", "Lluvia fuerte", "Lluvia torrencial"]
+
+
+# Función para clasificar la lluvia según mm/hora sobre toda la columna a la vez
+def clasificar_lluvia(prcp, umbrales=UMBRALES_LLUVIA, etiquetas=ETIQUETAS_LLUVIA):
+    if len(etiquetas) != len(umbrales) + 1:
+        raise ValueError("Tiene que haber una etiqueta más que umbrales")
+    valores = np.asarray(prcp, dtype='float64')
+    codigos = np.searchsorted(np.asarray(umbrales, dtype='float64'), valores, side='right')
+    codigos[np.isnan(valores)] = 0
+    clasificacion = pd.Categorical.from_codes(codigos, categories=etiquetas, ordered=True)
+    if isinstance(prcp, pd.Series):
+        return pd.Series(clasificacion, index=prcp.index, name=prcp.name)
+    return clasificacion
+
+
+def _ruta_fichero(ruta_cache, lat, lon, anio):
+    return os.path.join(ruta_cache, f'{lat:.4f}_{lon:.4f}', f'{anio}.parquet')
+
+
+def _leer_anio(ruta):
+    if not os.path.exists(ruta):
+        return None
+    return pd.read_parquet(ruta)
+
+
+def _escribir_anio(ruta, cache):
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = ruta + '.tmp'
+    cache.to_parquet(temporal)
+    os.replace(temporal, ruta)
+
+
+def _descargar(lat, lon, horas):
+    # Importamos meteostat aquí para que el modo offline no dependa de la librería
+    from meteostat import Point, Hourly
+
+    # Pedimos cada tramo continuo de horas que falta por separado
+    cortes = np.flatnonzero(horas[1:] - horas[:-1] != pd.Timedelta(hours=1)) + 1
+    tramos = [tramo for tramo in np.split(horas, cortes) if len(tramo)]
+    descargado = pd.concat([
+        Hourly(Point(lat, lon), tramo[0].to_pydatetime(), tramo[-1].to_pydatetime()).fetch()
+        for tramo in tramos
+    ])
+    descargado = descargado[~descargado.index.duplicated(keep='first')]
+    descargado = descargado[descargado.index.isin(horas)]
+    descargado[COLUMNA_CLASIFICACION] = clasificar_lluvia(descargado['prcp'])
+    descargado['sin_dato'] = False
+
+    # Horas que meteostat no devuelve: filas vacías para no pedirlas otra vez
+    limite = pd.Timestamp(datetime.now() - MARGEN_DATOS_RECIENTES)
+    sin_dato = horas.difference(descargado.index)
+    sin_dato = sin_dato[sin_dato < limite]
+    if len(sin_dato):
+        vacias = pd.DataFrame(index=sin_dato, columns=descargado.columns)
+        vacias[COLUMNA_CLASIFICACION] = None
+        vacias['sin_dato'] = True
+        descargado = pd.concat([descargado, vacias.astype(descargado.dtypes.to_dict())])
+    return descargado.sort_index()
+
+
+# Devuelve los datos horarios del punto entre `inicio` y `fin` (ambos incluidos),
+# leyendo de la caché y descargando solo las horas que falten.
+# Las horas sin dato en meteostat tienen la clasificación vacía. La caché guarda
+# la clasificación con los umbrales por defecto; si se piden otros se recalcula.
+def cargar_horario(lat, lon, inicio, fin, ruta_cache=RUTA_CACHE, offline=False,
+                   umbrales=UMBRALES_LLUVIA, etiquetas=ETIQUETAS_LLUVIA):
+    horas = pd.date_range(inicio, fin, freq='h', name='time')
+    anios = range(horas[0].year, horas[-1].year + 1)
+
+    caches = {anio: _leer_anio(_ruta_fichero(ruta_cache, lat, lon, anio)) for anio in anios}
+    en_cache = pd.DatetimeIndex([], name='time')
+    for cache in caches.values():
+        if cache is not None:
+            en_cache = en_cache.append(cache.index)
+    faltan = horas.difference(en_cache)
+
+    if len(faltan) and offline:
+        print(f"Modo offline: faltan {len(faltan)} horas en la caché de meteostat, se quedan sin dato.")
+    elif len(faltan):
+        print(f"Descargando {len(faltan)} horas de meteostat ({faltan.min()} - {faltan.max()})...")
+        descargado = _descargar(lat, lon, faltan)
+        for anio, nuevas in descargado.groupby(descargado.index.year):
+            cache = caches.get(anio)
+            cache = nuevas if cache is None else pd.concat([cache, nuevas]).sort_index()
+            caches[anio] = cache
+            _escribir_anio(_ruta_fichero(ruta_cache, lat, lon, anio), cache)
+
+    partes = [cache for cache in caches.values() if cache is not None]
+    if not partes:
+        raise FileNotFoundError(f"No hay datos de meteostat en caché para ({lat}, {lon}) en {ruta_cache}")
+    data = pd.concat(partes).sort_index()
+    data = data[(data.index >= horas[0]) & (data.index <= horas[-1])]
+    if list(umbrales) != UMBRALES_LLUVIA or list(etiquetas) != ETIQUETAS_LLUVIA:
+        data[COLUMNA_CLASIFICACION] = clasificar_lluvia(data['prcp'], umbrales, etiquetas)
+        data.loc[data['sin_dato'], COLUMNA_CLASIFICACION] = np.nan
+    print(f"Datos meteorológicos: {len(horas) - len(faltan)} horas leídas de caché, "
+          f"{len(faltan) if not offline else 0} pedidas a meteostat.")
+    return data.drop(columns=['sin_dato'])
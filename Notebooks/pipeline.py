@@ -0,0 +1,239 @@
+# Ejecuta las etapas 01-04 en orden, saltando las que no necesitan volver a ejecutarse.
+#
+# Cada etapa declara sus entradas, salidas, módulos y parámetros (variables de
+# entorno). Antes de ejecutarla se calcula una huella (sha256) con el contenido del
+# script, de los módulos, de las entradas y con el valor de los parámetros; si
+# coincide con la de la última ejecución y las salidas siguen intactas, la etapa se
+# salta. Como las salidas de una etapa son las entradas de la siguiente, cambiar
+# por ejemplo los parámetros del modelo en 04 solo vuelve a ejecutar la etapa 04.
+#
+# Las huellas se guardan en `.pipeline_manifiesto.json` dentro del directorio de
+# trabajo. La caché de meteostat no cuenta como entrada: es una copia local de una
+# fuente externa y se rellena sola en la etapa 01.
+#
+# Las rutas de los ficheros intermedios (RUTAS) se pueden cambiar con su variable de
+# entorno; si no se dan, apuntan al directorio de trabajo. Con TFM_INCREMENTAL=1 la
+# etapa 03 procesa solo el lote de TFM_RUTA_LOTE, que pasa a ser su entrada:
+#
+#     TFM_INCREMENTAL=1 TFM_RUTA_LOTE=lote_diario.arrow python pipeline.py 03
+#
+#     python pipeline.py                  # todas las etapas
+#     python pipeline.py --forzar 03 04   # vuelve a ejecutar 03 y 04 aunque no haya cambios
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+CARPETA_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+NOMBRE_MANIFIESTO = '.pipeline_manifiesto.json'
+ANIOS = range(2021, 2025)
+
+# Ficheros intermedios que las etapas reciben en variables de entorno: nombre que se
+# usa en las entradas y salidas, variable y ruta por defecto dentro del directorio de
+# trabajo (el lote no tiene ruta por defecto)
+RUTAS = {
+    'unido': ('TFM_RUTA_UNIDO', 'Accidentalidad_unido.arrow'),
+    'datos_modelo': ('TFM_RUTA_DATOS_MODELO', 'df_2020_final_con_gravedad.parquet'),
+    'modelo': ('TFM_RUTA_MODELO', 'modelo_gravedad'),
+    'lote': ('TFM_RUTA_LOTE', None),
+}
+
+# Las rutas de entradas y salidas son relativas al directorio de trabajo, salvo las
+# que empiezan por {originales} (carpeta con los CSV originales del Ayuntamiento) y
+# las de RUTAS ({unido}, {lote}...). 'entradas_incremental' sustituye a 'entradas'
+# en modo incremental.
+ETAPAS = [
+    {
+        'nombre': '01',
+        'script': '01. Preparación Datasets.py',
+        'modulos': ['meteo.py', 'lectura_datos.py'],
+        'entradas': [f'{{originales}}/{anio}_Accidentalidad.csv' for anio in ANIOS],
+        'salidas': [f'{anio}_Accidentalidad_COMPLETO.csv' for anio in ANIOS],
+        'parametros': ['METEO_OFFLINE'],
+    },
+    {
+        'nombre': '02',
+        'script': '02. Unión Datasets Anuales.py',
+        'modulos': ['lectura_datos.py'],
+        'entradas': [f'{anio}_Accidentalidad_COMPLETO.csv' for anio in ANIOS],
+        'salidas': ['Accidentalidad_unido', 'Accidentalidad_unido.arrow'],
+        'parametros': [],
+    },
+    {
+        'nombre': '03',
+        'script': '03. Creación Variables.py',
+        'modulos': ['lectura_datos.py', 'calendario.py', 'agregados.py'],
+        'entradas': ['{unido}'],
+        'entradas_incremental': ['{lote}'],
+        # En modo incremental (TFM_INCREMENTAL=1) se escribe lote_con_gravedad.parquet en
+        # lugar de los dos primeros; los agregados acumulados se actualizan siempre
+        'salidas': ['df_2020_final_con_gravedad.parquet', 'dataset_modelo_prediccion.parquet',
+                    'lote_con_gravedad.parquet', 'agregados.sqlite', 'agregaciones.xlsx'],
+        'parametros': ['TFM_INCREMENTAL', 'TFM_RUTA_LOTE', 'TFM_EXCEL', 'TFM_RUTA_AGREGADOS'],
+    },
+    {
+        'nombre': '04',
+        'script': '04. Modelo.py',
+        'modulos': ['lectura_datos.py', 'calendario.py', 'predictor.py'],
+        'entradas': ['{datos_modelo}'],
+        'salidas': ['{modelo}'],
+        'parametros': [],
+    },
+]
+
+
+def _hash_fichero(ruta, tamano_bloque=1 << 20):
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as fichero:
+        for bloque in iter(lambda: fichero.read(tamano_bloque), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+# Huella del contenido de un fichero o de todos los ficheros de una carpeta
+# (se ignoran los temporales: nombres que empiezan por '_' o '.' o acaban en .tmp)
+def huella_ruta(ruta):
+    if os.path.isfile(ruta):
+        return _hash_fichero(ruta)
+    if not os.path.isdir(ruta):
+        return None
+    h = hashlib.sha256()
+    for raiz, carpetas, ficheros in os.walk(ruta):
+        carpetas[:] = sorted(c for c in carpetas if not c.startswith(('_', '.')))
+        for nombre in sorted(ficheros):
+            if nombre.startswith(('_', '.')) or nombre.endswith('.tmp'):
+                continue
+            completa = os.path.join(raiz, nombre)
+            h.update(os.path.relpath(completa, ruta).replace(os.sep, '/').encode())
+            h.update(_hash_fichero(completa).encode())
+    return h.hexdigest()
+
+
+# Ruta de cada fichero de RUTAS: la de su variable de entorno o la de por defecto
+# (las relativas, respecto al directorio de trabajo)
+def rutas_intermedias(trabajo):
+    rutas = {}
+    for nombre, (variable, por_defecto) in RUTAS.items():
+        ruta = os.environ.get(variable) or por_defecto
+        if ruta is not None:
+            rutas[nombre] = os.path.join(trabajo, ruta)
+    return rutas
+
+
+def _resolver(ruta, trabajo, originales):
+    return os.path.join(trabajo, ruta.format(originales=originales, **rutas_intermedias(trabajo)))
+
+
+def entradas_etapa(etapa):
+    if os.environ.get('TFM_INCREMENTAL', '0') == '1' and 'entradas_incremental' in etapa:
+        if not os.environ.get('TFM_RUTA_LOTE'):
+            raise ValueError(f"Etapa {etapa['nombre']}: el modo incremental necesita TFM_RUTA_LOTE")
+        return etapa['entradas_incremental']
+    return etapa['entradas']
+
+
+# Huella de una etapa: script, módulos, entradas y parámetros
+def huella_etapa(etapa, trabajo, originales):
+    h = hashlib.sha256()
+    for nombre in [etapa['script']] + etapa['modulos']:
+        h.update(nombre.encode())
+        h.update(_hash_fichero(os.path.join(CARPETA_SCRIPTS, nombre)).encode())
+    for entrada in entradas_etapa(etapa):
+        ruta = _resolver(entrada, trabajo, originales)
+        huella = huella_ruta(ruta)
+        if huella is None:
+            raise FileNotFoundError(f"Etapa {etapa['nombre']}: no existe la entrada {ruta}")
+        h.update(entrada.encode())
+        h.update(huella.encode())
+    for parametro in etapa['parametros']:
+        h.update(f"{parametro}={os.environ.get(parametro, '')}".encode())
+    return h.hexdigest()
+
+
+def huellas_salidas(etapa, trabajo, originales):
+    return {salida: huella_ruta(_resolver(salida, trabajo, originales)) for salida in etapa['salidas']}
+
+
+def leer_manifiesto(trabajo):
+    ruta = os.path.join(trabajo, NOMBRE_MANIFIESTO)
+    if not os.path.exists(ruta):
+        return {}
+    with open(ruta, encoding='utf-8') as fichero:
+        return json.load(fichero)
+
+
+def guardar_manifiesto(trabajo, manifiesto):
+    ruta = os.path.join(trabajo, NOMBRE_MANIFIESTO)
+    temporal = ruta + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as fichero:
+        json.dump(manifiesto, fichero, indent=2, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+# Ejecuta el script de la etapa en un proceso aparte, con el directorio de trabajo
+# como carpeta actual y las rutas de entrada y salida en variables de entorno. Las
+# rutas de RUTAS que ya vengan en el entorno se respetan (son las mismas con las que
+# se calculan las huellas).
+def ejecutar_etapa(etapa, trabajo, originales):
+    entorno = dict(os.environ)
+    entorno['PYTHONPATH'] = os.pathsep.join(filter(None, [CARPETA_SCRIPTS, entorno.get('PYTHONPATH')]))
+    entorno['TFM_RUTA_ORIGINALES'] = originales
+    entorno['TFM_RUTA_RESULTADOS'] = trabajo
+    for nombre, ruta in rutas_intermedias(trabajo).items():
+        entorno[RUTAS[nombre][0]] = ruta
+    resultado = subprocess.run([sys.executable, os.path.join(CARPETA_SCRIPTS, etapa['script'])],
+                               cwd=trabajo, env=entorno)
+    if resultado.returncode != 0:
+        raise RuntimeError(f"La etapa {etapa['nombre']} ha fallado (código {resultado.returncode})")
+
+
+def ejecutar_pipeline(trabajo, originales, etapas=None, forzar=()):
+    trabajo = os.path.abspath(trabajo)
+    originales = os.path.abspath(originales)
+    manifiesto = leer_manifiesto(trabajo)
+    informe = []
+
+    for etapa in ETAPAS:
+        if etapas and etapa['nombre'] not in etapas:
+            continue
+        inicio = time.perf_counter()
+        huella = huella_etapa(etapa, trabajo, originales)
+        anterior = manifiesto.get(etapa['nombre'], {})
+        en_cache = (etapa['nombre'] not in forzar
+                    and anterior.get('huella') == huella
+                    and anterior.get('salidas') == huellas_salidas(etapa, trabajo, originales))
+        if en_cache:
+            estado = 'caché'
+        else:
+            print(f"\n=== Etapa {etapa['nombre']}: {etapa['script']} ===")
+            ejecutar_etapa(etapa, trabajo, originales)
+            manifiesto[etapa['nombre']] = {
+                'huella': huella,
+                'salidas': huellas_salidas(etapa, trabajo, originales),
+            }
+            guardar_manifiesto(trabajo, manifiesto)
+            estado = 'ejecutada'
+        informe.append((etapa['nombre'], estado, time.perf_counter() - inicio))
+
+    print("\nEtapa  Estado      Tiempo")
+    for nombre, estado, segundos in informe:
+        print(f"{nombre:<6} {estado:<11} {segundos:8.2f} s")
+    print(f"Caché: {sum(estado == 'caché' for _, estado, _ in informe)} de {len(informe)} etapas")
+    return informe
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ejecuta las etapas 01-04 con caché por contenido")
+    parser.add_argument('etapas', nargs='*', help="etapas a ejecutar (por defecto todas)")
+    parser.add_argument('--trabajo', default=os.environ.get('TFM_TRABAJO', CARPETA_SCRIPTS),
+                        help="directorio donde se leen y escriben los ficheros intermedios")
+    parser.add_argument('--originales', default=os.environ.get('TFM_RUTA_ORIGINALES', 'Dataset originales'),
+                        help="carpeta con los CSV originales del Ayuntamiento")
+    parser.add_argument('--forzar', action='store_true', help="ejecutar las etapas aunque estén en caché")
+    argumentos = parser.parse_args()
+    etapas = argumentos.etapas or [etapa['nombre'] for etapa in ETAPAS]
+    ejecutar_pipeline(argumentos.trabajo, argumentos.originales, etapas,
+                      forzar=etapas if argumentos.forzar else ())
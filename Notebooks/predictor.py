@@ -0,0 +1,271 @@
+# Modelo de gravedad exportado y predictor que lo carga sin depender del entrenamiento.
+#
+# El entrenamiento (04. Modelo.py) guarda cada versión del modelo en su carpeta:
+#
+#     modelo_gravedad/<version>/modelo.ubj     booster de XGBoost en formato binario
+#     modelo_gravedad/<version>/esquema.json   columnas, tipos y categorías
+#     modelo_gravedad/ultima_version.txt       versión que se carga por defecto
+#
+# La versión es un hash del contenido del modelo. `Predictor` solo necesita numpy,
+# json y xgboost: las filas se codifican con las categorías del esquema (los
+# valores desconocidos quedan como nulos) y se predicen con inplace_predict.
+# `CodificadorEscenarios` hace lo mismo para escenarios en todos los distritos y
+# `CachePredicciones` guarda las predicciones de los escenarios más consultados.
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import xgboost as xgb
+
+RUTA_MODELO = 'modelo_gravedad'
+FICHERO_MODELO = 'modelo.ubj'
+FICHERO_ESQUEMA = 'esquema.json'
+FICHERO_VERSION = 'ultima_version.txt'
+
+
+# Escritura atómica: un trabajador que cargue el modelo a la vez nunca ve un fichero a medias
+def _escribir(ruta, contenido):
+    temporal = ruta + '.tmp'
+    with open(temporal, 'wb') as fichero:
+        fichero.write(contenido)
+    os.replace(temporal, ruta)
+
+
+# Guarda el booster y el esquema de las columnas de entrenamiento `X` (un DataFrame
+# con categóricas de pandas). Devuelve la versión.
+def exportar_modelo(booster, X, carpeta=RUTA_MODELO, objetivo='indice_gravedad'):
+    modelo = bytes(booster.save_raw(raw_format='ubj'))
+    version = hashlib.sha256(modelo).hexdigest()[:12]
+
+    columnas = []
+    for nombre, tipo in X.dtypes.items():
+        columna = {'nombre': nombre, 'dtype': str(tipo)}
+        if hasattr(tipo, 'categories'):
+            columna['categorias'] = [str(categoria) for categoria in tipo.categories]
+        columnas.append(columna)
+    esquema = {
+        'version': version,
+        'creado': datetime.now().isoformat(timespec='seconds'),
+        'xgboost': xgb.__version__,
+        'objetivo': objetivo,
+        'columnas': columnas,
+    }
+
+    destino = os.path.join(carpeta, version)
+    os.makedirs(destino, exist_ok=True)
+    _escribir(os.path.join(destino, FICHERO_MODELO), modelo)
+    _escribir(os.path.join(destino, FICHERO_ESQUEMA), json.dumps(esquema, indent=2, ensure_ascii=False).encode('utf-8'))
+    _escribir(os.path.join(carpeta, FICHERO_VERSION), version.encode('utf-8'))
+    return version
+
+
+# Versión que apunta ultima_version.txt (la que se carga por defecto)
+def version_actual(carpeta=RUTA_MODELO):
+    with open(os.path.join(carpeta, FICHERO_VERSION), encoding='utf-8') as fichero:
+        return fichero.read().strip()
+
+
+class Predictor:
+    def __init__(self, carpeta=RUTA_MODELO, version=None):
+        if version is None:
+            version = version_actual(carpeta)
+        origen = os.path.join(carpeta, version)
+        with open(os.path.join(origen, FICHERO_ESQUEMA), encoding='utf-8') as fichero:
+            self.esquema = json.load(fichero)
+        self.booster = xgb.Booster(model_file=os.path.join(origen, FICHERO_MODELO))
+        self.version = self.esquema['version']
+        self.columnas = [columna['nombre'] for columna in self.esquema['columnas']]
+        # Código de cada categoría (su posición en la lista) para las columnas categóricas
+        self.codigos = {
+            columna['nombre']: {categoria: float(i) for i, categoria in enumerate(columna['categorias'])}
+            for columna in self.esquema['columnas'] if 'categorias' in columna
+        }
+
+    # Valor numérico de una columna tal como lo ve el modelo (código si es categórica;
+    # nulo si la categoría no existe en el entrenamiento)
+    def valor(self, nombre, valor):
+        codigos = self.codigos.get(nombre)
+        if codigos is None:
+            return float(valor)
+        return codigos.get(str(valor), np.nan)
+
+    # Matriz (filas x columnas del modelo) a partir de una lista de diccionarios.
+    # Las columnas que falten y las categorías desconocidas quedan como nulos.
+    def codificar(self, filas):
+        matriz = np.full((len(filas), len(self.columnas)), np.nan, dtype=np.float32)
+        for j, nombre in enumerate(self.columnas):
+            for i, fila in enumerate(filas):
+                valor = fila.get(nombre)
+                if valor is not None:
+                    matriz[i, j] = self.valor(nombre, valor)
+        return matriz
+
+    def predecir(self, filas):
+        if not filas:
+            return np.empty(0, dtype=np.float32)
+        return self.booster.inplace_predict(self.codificar(filas))
+
+    def codificador(self, distritos=None):
+        return CodificadorEscenarios(self, distritos)
+
+
+# Codificador para puntuar escenarios en todos los distritos a la vez.
+#
+# Un escenario es un diccionario con los valores comunes (mes, día, franja, clima...);
+# cada escenario se expande a una fila por distrito. Las posiciones de las columnas y
+# los códigos de los distritos se calculan una vez, y las filas se escriben en una
+# matriz reservada de antemano que se reutiliza entre llamadas, de modo que N
+# escenarios x distritos se predicen con un solo inplace_predict. La matriz es
+# compartida: una instancia no debe usarse desde varios hilos a la vez.
+class CodificadorEscenarios:
+    def __init__(self, predictor, distritos=None, columna_distrito='distrito'):
+        self.predictor = predictor
+        if distritos is None:
+            distritos = list(predictor.codigos[columna_distrito])
+        self.distritos = list(distritos)
+        self.columna_distrito = columna_distrito
+        self.posiciones = {nombre: j for j, nombre in enumerate(predictor.columnas)}
+        self._posicion_distrito = self.posiciones[columna_distrito]
+        self._codigos_distrito = np.array(
+            [predictor.valor(columna_distrito, distrito) for distrito in self.distritos], dtype=np.float32)
+        self._matriz = np.empty((0, len(predictor.columnas)), dtype=np.float32)
+
+    def _reservar(self, filas):
+        if self._matriz.shape[0] < filas:
+            self._matriz = np.empty((filas, self._matriz.shape[1]), dtype=np.float32)
+        matriz = self._matriz[:filas]
+        matriz.fill(np.nan)
+        return matriz
+
+    # Matriz (escenarios x distritos, columnas del modelo). Es una vista sobre la
+    # matriz reservada: deja de ser válida en la siguiente llamada.
+    def codificar(self, escenarios):
+        matriz = self._reservar(len(escenarios) * len(self.distritos))
+        bloques = matriz.reshape(len(escenarios), len(self.distritos), -1)
+        for i, escenario in enumerate(escenarios):
+            fila = bloques[i, 0]
+            for nombre, valor in escenario.items():
+                j = self.posiciones.get(nombre)
+                if j is not None and valor is not None:
+                    fila[j] = self.predictor.valor(nombre, valor)
+            # La primera fila se copia al resto de distritos del escenario
+            bloques[i, 1:] = fila
+        bloques[:, :, self._posicion_distrito] = self._codigos_distrito
+        return matriz
+
+    # Predicciones con forma (escenarios, distritos)
+    def predecir(self, escenarios):
+        if not escenarios:
+            return np.empty((0, len(self.distritos)), dtype=np.float32)
+        prediccion = self.predictor.booster.inplace_predict(self.codificar(escenarios))
+        return prediccion.reshape(len(escenarios), len(self.distritos))
+
+
+# Caché LRU con caducidad de las predicciones por escenario (una fila por distrito).
+#
+# La clave es la versión del modelo y el escenario normalizado: el valor que ve el
+# modelo en cada columna (sin el distrito), de modo que 'Tarde' y su código, True y
+# 1 o 5 y 5.0 dan la misma entrada, y los campos que el modelo no usa no cuentan.
+# Si cambia la versión del modelo del codificador, la caché se vacía. Se puede usar
+# desde varios hilos: las consultas y las altas van protegidas con un lock.
+class CachePredicciones:
+    def __init__(self, codificador, max_entradas=4096, segundos_validez=3600):
+        self.codificador = codificador
+        self.max_entradas = max_entradas
+        self.segundos_validez = segundos_validez
+        self._entradas = OrderedDict()
+        self._version = codificador.predictor.version
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.caducadas = 0
+        self.expulsadas = 0
+        self.invalidaciones = 0
+
+    def clave(self, escenario):
+        predictor = self.codificador.predictor
+        valores = []
+        for nombre in predictor.columnas:
+            valor = escenario.get(nombre)
+            if nombre == self.codificador.columna_distrito or valor is None:
+                valores.append(None)
+                continue
+            valor = predictor.valor(nombre, valor)
+            valores.append(None if valor != valor else valor)
+        return (predictor.version, tuple(valores))
+
+    def _comprobar_version(self):
+        version = self.codificador.predictor.version
+        if version != self._version:
+            self._entradas.clear()
+            self._version = version
+            self.invalidaciones += 1
+
+    # Predicciones guardadas de cada clave (None si no está o ha caducado)
+    def buscar(self, claves):
+        ahora = time.monotonic()
+        encontradas = []
+        with self._lock:
+            self._comprobar_version()
+            for clave in claves:
+                entrada = self._entradas.get(clave)
+                if entrada is not None and ahora - entrada[0] > self.segundos_validez:
+                    del self._entradas[clave]
+                    self.caducadas += 1
+                    entrada = None
+                if entrada is None:
+                    self.fallos += 1
+                    encontradas.append(None)
+                else:
+                    self._entradas.move_to_end(clave)
+                    self.aciertos += 1
+                    encontradas.append(entrada[1])
+        return encontradas
+
+    def guardar(self, claves, predicciones):
+        ahora = time.monotonic()
+        with self._lock:
+            self._comprobar_version()
+            for clave, prediccion in zip(claves, predicciones):
+                # Las claves de otra versión (calculadas antes de recargar el modelo) no se guardan
+                if clave[0] != self._version:
+                    continue
+                self._entradas[clave] = (ahora, np.array(prediccion, copy=True))
+                self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+                self.expulsadas += 1
+
+    # Como CodificadorEscenarios.predecir: solo se predicen los escenarios que no
+    # estén en la caché, todos en un lote
+    def predecir(self, escenarios):
+        claves = [self.clave(escenario) for escenario in escenarios]
+        encontradas = self.buscar(claves)
+        faltan = [i for i, prediccion in enumerate(encontradas) if prediccion is None]
+        if faltan:
+            nuevas = self.codificador.predecir([escenarios[i] for i in faltan])
+            self.guardar([claves[i] for i in faltan], nuevas)
+            for i, prediccion in zip(faltan, nuevas):
+                encontradas[i] = prediccion
+        if not encontradas:
+            return np.empty((0, len(self.codificador.distritos)), dtype=np.float32)
+        return np.stack(encontradas)
+
+    def resumen(self):
+        consultas = self.aciertos + self.fallos
+        return {
+            'entradas': len(self._entradas),
+            'max_entradas': self.max_entradas,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0,
+            'caducadas': self.caducadas,
+            'expulsadas': self.expulsadas,
+            'invalidaciones': self.invalidaciones,
+            'version': self._version,
+        }
@@ -0,0 +1,338 @@
+# Servicio HTTP/JSON local con las predicciones del índice de gravedad por distrito.
+#
+# Carga el modelo exportado por la etapa 04 (ver predictor.py) y atiende varias
+# peticiones a la vez con asyncio. Las peticiones que llegan dentro de una ventana
+# corta (unos milisegundos) se juntan en un solo lote y se predicen con una única
+# llamada a inplace_predict; el lote se calcula en un hilo aparte para no bloquear
+# el bucle de eventos mientras tanto.
+#
+# Delante de los lotes hay una caché LRU con caducidad (CachePredicciones): los
+# escenarios ya consultados se responden sin esperar a la ventana ni predecir. Cada
+# cierto tiempo se mira ultima_version.txt; si la etapa 04 ha exportado un modelo
+# nuevo, se carga y la caché se vacía.
+#
+#     python servicio_prediccion.py --puerto 8000
+#
+#     POST /prediccion  {"escenarios": [{"mes": 5, "día": 3, "franja_horaria": "Tarde", ...}]}
+#                       (o un solo escenario sin la lista)
+#                       -> {"version": ..., "distritos": [...], "predicciones": [[...], ...]}
+#     GET  /metricas    contadores de peticiones, lotes, caché, latencia y rendimiento
+#     GET  /salud       estado y versión del modelo
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xgboost as xgb
+
+from predictor import RUTA_MODELO, CachePredicciones, Predictor, version_actual
+
+VENTANA_MS = 2
+MAX_LOTE = 1024
+MAX_CACHE = 4096
+SEGUNDOS_CACHE = 3600
+SEGUNDOS_COMPROBAR_VERSION = 30
+MAX_CUERPO = 1 << 20
+TEXTOS_ESTADO = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class Metricas:
+    def __init__(self, muestras=2000):
+        self.inicio = time.perf_counter()
+        self.peticiones = 0
+        self.errores = 0
+        self.escenarios = 0
+        self.lotes = 0
+        self.escenarios_en_lotes = 0
+        self.tiempo_prediccion = 0.0
+        # Latencias de las últimas peticiones para los percentiles
+        self.latencias = deque(maxlen=muestras)
+
+    def registrar_peticion(self, segundos, escenarios):
+        self.peticiones += 1
+        self.escenarios += escenarios
+        self.latencias.append(segundos)
+
+    def registrar_lote(self, segundos, escenarios):
+        self.lotes += 1
+        self.escenarios_en_lotes += escenarios
+        self.tiempo_prediccion += segundos
+
+    def resumen(self):
+        activo = time.perf_counter() - self.inicio
+        latencias = np.array(self.latencias) * 1000
+        percentiles = (dict(zip(['p50', 'p95', 'p99'], np.percentile(latencias, [50, 95, 99]).round(3).tolist()))
+                       if len(latencias) else {})
+        return {
+            'segundos_activo': round(activo, 1),
+            'peticiones': self.peticiones,
+            'errores': self.errores,
+            'escenarios': self.escenarios,
+            'peticiones_por_segundo': round(self.peticiones / activo, 2) if activo else 0,
+            'escenarios_por_segundo': round(self.escenarios / activo, 2) if activo else 0,
+            'lotes': self.lotes,
+            'escenarios_por_lote': round(self.escenarios_en_lotes / self.lotes, 2) if self.lotes else 0,
+            'ms_prediccion_por_lote': round(self.tiempo_prediccion / self.lotes * 1000, 3) if self.lotes else 0,
+            'latencia_ms': {'media': round(float(latencias.mean()), 3) if len(latencias) else 0, **percentiles},
+        }
+
+
+# Junta los escenarios de las peticiones concurrentes y los predice por lotes.
+# Un único hilo hace las predicciones, así que el codificador (que reutiliza su
+# matriz) nunca se usa desde dos hilos a la vez.
+class PrediccionPorLotes:
+    def __init__(self, codificador, metricas, ventana_ms=VENTANA_MS, max_lote=MAX_LOTE):
+        self.codificador = codificador
+        self.metricas = metricas
+        self.ventana = ventana_ms / 1000
+        self.max_lote = max_lote
+        self._cola = asyncio.Queue()
+        self._hilo = ThreadPoolExecutor(max_workers=1)
+        self._tarea = None
+
+    def iniciar(self):
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+        self._hilo.shutdown(wait=False)
+
+    # Devuelve el codificador con el que se ha predicho el lote (el modelo puede
+    # cambiar mientras la petición espera) y las predicciones (escenarios x distritos)
+    async def predecir(self, escenarios):
+        futuro = asyncio.get_running_loop().create_future()
+        await self._cola.put((escenarios, futuro))
+        return await futuro
+
+    def _predecir_lote(self, codificador, escenarios):
+        inicio = time.perf_counter()
+        prediccion = codificador.predecir(escenarios)
+        self.metricas.registrar_lote(time.perf_counter() - inicio, len(escenarios))
+        return prediccion
+
+    async def _bucle(self):
+        bucle = asyncio.get_running_loop()
+        while True:
+            pendientes = [await self._cola.get()]
+            total = len(pendientes[0][0])
+            # Se espera a más peticiones hasta que acaba la ventana o se llena el lote
+            limite = bucle.time() + self.ventana
+            while total < self.max_lote:
+                restante = limite - bucle.time()
+                if restante <= 0:
+                    break
+                try:
+                    pendiente = await asyncio.wait_for(self._cola.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+                pendientes.append(pendiente)
+                total += len(pendiente[0])
+
+            escenarios = [escenario for lote, _ in pendientes for escenario in lote]
+            codificador = self.codificador
+            try:
+                prediccion = await bucle.run_in_executor(self._hilo, self._predecir_lote, codificador, escenarios)
+            except Exception as error:
+                for _, futuro in pendientes:
+                    if not futuro.done():
+                        futuro.set_exception(error)
+                continue
+            inicio = 0
+            for lote, futuro in pendientes:
+                if not futuro.done():
+                    futuro.set_result((codificador, prediccion[inicio:inicio + len(lote)]))
+                inicio += len(lote)
+
+
+class ErrorPeticion(Exception):
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+
+
+# Comprueba el cuerpo de POST /prediccion y devuelve la lista de escenarios. Los
+# valores se validan aquí para que un escenario incorrecto no haga fallar el lote
+# con las peticiones de otros clientes.
+def leer_escenarios(cuerpo, predictor):
+    try:
+        datos = json.loads(cuerpo or b'null')
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ErrorPeticion(400, "El cuerpo no es un JSON válido")
+    escenarios = datos.get('escenarios', [datos]) if isinstance(datos, dict) else None
+    if not isinstance(escenarios, list) or not escenarios or not all(isinstance(e, dict) for e in escenarios):
+        raise ErrorPeticion(400, "Se espera un escenario o {'escenarios': [escenario, ...]}")
+    for escenario in escenarios:
+        for nombre, valor in escenario.items():
+            if nombre not in predictor.codigos and valor is not None:
+                try:
+                    predictor.valor(nombre, valor)
+                except (TypeError, ValueError):
+                    raise ErrorPeticion(400, f"Valor no numérico en '{nombre}': {valor!r}")
+    return escenarios
+
+
+class ServicioPrediccion:
+    def __init__(self, predictor, ventana_ms=VENTANA_MS, max_lote=MAX_LOTE,
+                 max_cache=MAX_CACHE, segundos_cache=SEGUNDOS_CACHE, carpeta=None):
+        self.predictor = predictor
+        self.codificador = predictor.codificador()
+        self.metricas = Metricas()
+        self.cache = CachePredicciones(self.codificador, max_cache, segundos_cache)
+        self.lotes = PrediccionPorLotes(self.codificador, self.metricas, ventana_ms, max_lote)
+        # Carpeta donde se buscan versiones nuevas del modelo (None: versión fija)
+        self.carpeta = carpeta
+
+    # Carga la última versión exportada si es distinta de la actual. El cambio se
+    # hace de una vez: los lotes siguientes y la caché pasan a usar el modelo nuevo.
+    async def _recargar_modelo(self):
+        bucle = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(SEGUNDOS_COMPROBAR_VERSION)
+            try:
+                version = version_actual(self.carpeta)
+                if version == self.predictor.version:
+                    continue
+                predictor = await bucle.run_in_executor(None, Predictor, self.carpeta, version)
+            except (OSError, ValueError, xgb.core.XGBoostError) as error:
+                print(f"No se ha podido cargar el modelo nuevo: {error}")
+                continue
+            codificador = predictor.codificador()
+            self.predictor, self.codificador = predictor, codificador
+            self.lotes.codificador = codificador
+            self.cache.codificador = codificador
+            print(f"Modelo actualizado a la versión {predictor.version}")
+
+    # Devuelve el codificador del modelo que ha dado las predicciones y las
+    # predicciones. Si el modelo cambia mientras se espera al lote, la petición se
+    # repite con el nuevo para no mezclar predicciones de dos versiones.
+    async def _predecir(self, escenarios):
+        while True:
+            codificador = self.cache.codificador
+            claves = [self.cache.clave(escenario) for escenario in escenarios]
+            encontradas = self.cache.buscar(claves)
+            faltan = [i for i, prediccion in enumerate(encontradas) if prediccion is None]
+            if faltan:
+                usado, nuevas = await self.lotes.predecir([escenarios[i] for i in faltan])
+                if usado is not codificador:
+                    continue
+                self.cache.guardar([claves[i] for i in faltan], nuevas)
+                for i, prediccion in zip(faltan, nuevas):
+                    encontradas[i] = prediccion
+            return codificador, np.stack(encontradas)
+
+    async def _responder(self, metodo, ruta, cuerpo):
+        if ruta == '/prediccion':
+            if metodo != 'POST':
+                raise ErrorPeticion(405, "Use POST")
+            escenarios = leer_escenarios(cuerpo, self.predictor)
+            codificador, prediccion = await self._predecir(escenarios)
+            return len(escenarios), {
+                'version': codificador.predictor.version,
+                'distritos': codificador.distritos,
+                'predicciones': prediccion.round(6).tolist(),
+            }
+        if ruta == '/metricas' and metodo == 'GET':
+            return 0, {**self.metricas.resumen(), 'cache': self.cache.resumen()}
+        if ruta == '/salud' and metodo == 'GET':
+            return 0, {'estado': 'ok', 'version': self.predictor.version}
+        raise ErrorPeticion(404, f"No existe {metodo} {ruta}")
+
+    # Atiende una conexión HTTP/1.1 (con keep-alive si el cliente lo pide)
+    async def atender(self, lector, escritor):
+        try:
+            while True:
+                linea = await lector.readline()
+                if not linea:
+                    break
+                try:
+                    metodo, ruta, version_http = linea.decode('latin-1').split()
+                except ValueError:
+                    break
+                cabeceras = {}
+                while True:
+                    cabecera = await lector.readline()
+                    if cabecera in (b'\r\n', b'\n', b''):
+                        break
+                    nombre, _, valor = cabecera.decode('latin-1').partition(':')
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+                longitud = int(cabeceras.get('content-length', 0) or 0)
+                mantener = (cabeceras.get('connection', '').lower() != 'close'
+                            and version_http == 'HTTP/1.1')
+
+                inicio = time.perf_counter()
+                try:
+                    if longitud > MAX_CUERPO:
+                        mantener = False
+                        raise ErrorPeticion(413, "Cuerpo demasiado grande")
+                    cuerpo = await lector.readexactly(longitud) if longitud else b''
+                    escenarios, respuesta = await self._responder(metodo, ruta.split('?')[0], cuerpo)
+                    estado = 200
+                except ErrorPeticion as error:
+                    escenarios, estado, respuesta = 0, error.estado, {'error': str(error)}
+                except Exception as error:
+                    escenarios, estado, respuesta = 0, 500, {'error': str(error)}
+                if estado == 200:
+                    if escenarios:
+                        self.metricas.registrar_peticion(time.perf_counter() - inicio, escenarios)
+                else:
+                    self.metricas.errores += 1
+
+                datos = json.dumps(respuesta, ensure_ascii=False).encode('utf-8')
+                escritor.write(
+                    f"HTTP/1.1 {estado} {TEXTOS_ESTADO[estado]}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(datos)}\r\n"
+                    f"Connection: {'keep-alive' if mantener else 'close'}\r\n\r\n".encode('latin-1') + datos)
+                await escritor.drain()
+                if not mantener:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            escritor.close()
+
+    async def servir(self, host, puerto):
+        self.lotes.iniciar()
+        if self.carpeta is not None:
+            recarga = asyncio.get_running_loop().create_task(self._recargar_modelo())
+        servidor = await asyncio.start_server(self.atender, host, puerto)
+        print(f"Modelo {self.predictor.version} ({len(self.codificador.distritos)} distritos) "
+              f"en http://{host}:{puerto}")
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            if self.carpeta is not None:
+                recarga.cancel()
+            await self.lotes.detener()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servicio local de predicción del índice de gravedad")
+    parser.add_argument('--modelo', default=os.environ.get('TFM_RUTA_MODELO', RUTA_MODELO),
+                        help="carpeta con el modelo exportado por la etapa 04")
+    parser.add_argument('--version', default=None, help="versión del modelo (por defecto la última)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8000)
+    parser.add_argument('--ventana-ms', type=float, default=VENTANA_MS,
+                        help="tiempo que se esperan más peticiones para juntarlas en un lote")
+    parser.add_argument('--max-lote', type=int, default=MAX_LOTE, help="máximo de escenarios por lote")
+    parser.add_argument('--max-cache', type=int, default=MAX_CACHE, help="escenarios guardados en la caché")
+    parser.add_argument('--segundos-cache', type=float, default=SEGUNDOS_CACHE,
+                        help="tiempo que una predicción sigue siendo válida en la caché")
+    argumentos = parser.parse_args()
+    # Con --version el modelo queda fijo; si no, se sigue la última versión exportada
+    servicio = ServicioPrediccion(Predictor(argumentos.modelo, argumentos.version),
+                                  argumentos.ventana_ms, argumentos.max_lote,
+                                  argumentos.max_cache, argumentos.segundos_cache,
+                                  carpeta=None if argumentos.version else argumentos.modelo)
+    try:
+        asyncio.run(servicio.servir(argumentos.host, argumentos.puerto))
+    except KeyboardInterrupt:
+        pass